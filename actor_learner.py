@@ -0,0 +1,219 @@
+from __future__ import print_function
+import json
+import multiprocessing
+import time
+import numpy as np
+from maze_env import ACTIONS, DELTAS, MAP_LENGTH, MAP_WIDTH, UNKNOWN, LAND, TARGET, SELF
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+from grid_decoder import decode_grid
+from mission_spec import mission_spec
+
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
+
+# Keras/TensorFlow state does not survive fork(), so actors start fresh when possible
+if hasattr(multiprocessing, 'get_context'):
+    processes = multiprocessing.get_context('spawn')
+else:
+    processes = multiprocessing
+
+
+class ClientMazeEnv(object):
+    """One Minecraft client behind the maze_env.BatchMazeEnv interface (n = 1).
+
+    Every episode is a fresh mission_spec(**mission) on the client at
+    host:port. Moves are scored from the decoded floorAll grid like
+    Tabular.act (step_reward, goal_reward on the end block, fall_reward on
+    a gap or off the maze), and a finished episode starts the next mission
+    straight away.
+    """
+
+    def __init__(self, port, mission, host="127.0.0.1",
+                 step_reward=-1, goal_reward=100, fall_reward=-50):
+        import MalmoPython
+        self.MalmoPython = MalmoPython
+        self.agent_host = MalmoPython.AgentHost()
+        self.client_pool = MalmoPython.ClientPool()
+        self.client_pool.add(MalmoPython.ClientInfo(host, port))
+        self.mission = mission
+        self.step_reward = step_reward
+        self.goal_reward = goal_reward
+        self.fall_reward = fall_reward
+        self.n = 1
+        self.episodes = 0
+        self.maze = np.zeros((MAP_LENGTH, MAP_WIDTH), dtype=np.int8)
+        self.position = [-1, -1]
+        self.boundary = [-1, -1, -1, -1]
+
+    def start_mission(self):
+        mission = mission_spec(**self.mission)
+        max_retries = 3
+        for retry in range(max_retries):
+            try:
+                self.agent_host.startMission(mission, self.client_pool,
+                                             self.MalmoPython.MissionRecordSpec(), 0, "iKun")
+                break
+            except RuntimeError:
+                if retry == max_retries - 1:
+                    raise
+                time.sleep(2)
+        self.episodes += 1
+
+        world_state = self.agent_host.getWorldState()
+        while not world_state.has_mission_begun:
+            time.sleep(0.1)
+            world_state = self.agent_host.getWorldState()
+
+    def reset(self):
+        grid = None
+        while grid is None:
+            self.start_mission()
+            world_state = wait_for_world_state(self.agent_host, observation=True, reward=False)
+            if world_state.observations:
+                grid = json.loads(world_state.observations[-1].text).get(u'floorAll')
+        self.maze, start, _, self.boundary = decode_grid(grid)
+        self.position = list(start)
+        return self.canvases()
+
+    def canvases(self):
+        canvas = self.maze.astype(np.float32)
+        x, z = self.position
+        if 0 <= x < MAP_LENGTH and 0 <= z < MAP_WIDTH:
+            canvas[x, z] = SELF
+        return canvas.reshape((1, -1))
+
+    def valid_actions(self):
+        x, z = self.position
+        return np.array([[z > self.boundary[1], z < self.boundary[3],
+                          x > self.boundary[0], x < self.boundary[2]]])
+
+    def step(self, actions):
+        action = int(actions[0])
+        self.agent_host.sendCommand(ACTIONS[action])
+        self.position = [self.position[0] + DELTAS[action][0], self.position[1] + DELTAS[action][1]]
+        world_state = wait_for_world_state(self.agent_host)
+
+        x, z = self.position
+        code = self.maze[x, z] if 0 <= x < MAP_LENGTH and 0 <= z < MAP_WIDTH else UNKNOWN
+        if code == TARGET:
+            reward = self.goal_reward
+        elif code == LAND:
+            reward = self.step_reward
+        else:
+            reward = self.fall_reward
+        done = code != LAND or not world_state.is_mission_running
+
+        next_canvases = self.canvases()
+        if done:
+            wait_for_mission_end(self.agent_host)
+            self.reset()
+        return next_canvases, np.array([reward], dtype=np.float32), np.array([done])
+
+
+def latest(queue):
+    """Newest item waiting in queue, or None."""
+    item = None
+    while True:
+        try:
+            item = queue.get_nowait()
+        except Empty:
+            return item
+
+
+def run_actor(index, make_env, make_agent, transitions, weights, stop, steps_per_send, model=None):
+    """Actor process: act with the newest weights and ship transitions in chunks.
+
+    make_env(index) and make_agent(index) build the environment and an agent
+    with act_batch and model in this process; with model set (a RemoteModel
+    of an inference_server.InferenceServer) the agent is built around it
+    with make_agent(index, model=model). Canvases are sent as int8 since
+    they only hold the maze codes.
+    """
+    env = make_env(index)
+    agent = make_agent(index) if model is None else make_agent(index, model=model)
+    canvas = env.reset()
+    chunk = []
+    while not stop.is_set():
+        new_weights = latest(weights)
+        if new_weights is not None:
+            agent.model.set_weights(new_weights)
+
+        actions = agent.act_batch(canvas, env.valid_actions())
+        canvas_next, rewards, dones = env.step(actions)
+        chunk.append((canvas.astype(np.int8), actions.astype(np.uint8), rewards,
+                      canvas_next.astype(np.int8), dones))
+        canvas = env.canvases()
+
+        if len(chunk) >= steps_per_send:
+            transitions.put(tuple(np.concatenate(column) for column in zip(*chunk)))
+            chunk = []
+
+
+class ActorPool(object):
+    """N actor processes feeding one learner.
+
+    Each actor drives its own environment (a Minecraft client on its own
+    port, or a headless stand-in) and puts chunks of transitions on a shared
+    queue; collect() moves them into the learner's replay memory and
+    broadcast() hands new weights to every actor, replacing any it hasn't
+    picked up yet. make_env and make_agent must be picklable (module-level
+    functions or functools.partial of them). With server set, actors predict
+    through that inference_server.InferenceServer (started with at least
+    `actors` clients) instead of keeping a model each, and broadcast() goes
+    to the server.
+    """
+
+    def __init__(self, make_env, make_agent, actors=3, steps_per_send=32, max_chunks=64,
+                 server=None):
+        self.transitions = processes.Queue(max_chunks)
+        self.weights = [processes.Queue(1) for _ in range(actors)]
+        self.stop_event = processes.Event()
+        self.server = server
+        self.processes = [processes.Process(target=run_actor, args=(
+            i, make_env, make_agent, self.transitions, self.weights[i], self.stop_event, steps_per_send,
+            None if server is None else server.client(i)))
+            for i in range(actors)]
+        self.steps = 0
+
+    def start(self):
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    def collect(self, memory, block=False, timeout=None):
+        """Move waiting transitions into memory; returns how many arrived."""
+        received = 0
+        while True:
+            try:
+                chunk = self.transitions.get(block and not received, timeout)
+            except Empty:
+                break
+            memory.extend(*chunk)
+            received += len(chunk[1])
+        self.steps += received
+        return received
+
+    def broadcast(self, weights):
+        if self.server is not None:
+            self.server.set_weights(weights)
+            return
+        for queue in self.weights:
+            latest(queue)
+            try:
+                queue.put_nowait(weights)
+            except Full:
+                pass
+
+    def stop(self):
+        self.stop_event.set()
+        # Actors blocked on a full transition queue need it drained to exit
+        deadline = time.time() + 5
+        while any(process.is_alive() for process in self.processes) and time.time() < deadline:
+            latest(self.transitions)
+            time.sleep(0.01)
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
@@ -0,0 +1,128 @@
+from __future__ import print_function
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class BackgroundLearner(object):
+    """Train an agent in a background thread while the step loop keeps acting.
+
+    The step loop calls push() with each transition and predict() to act;
+    the learner thread moves transitions into agent.memory and calls
+    train(updates) for one gradient step at a time on agent.model. Every
+    publish_every updates it publishes the weights, and refresh() (called
+    from the step loop) loads them into acting_model, a copy of the model
+    only the step loop uses, so Keras never predicts and fits the same model
+    from two threads. With max_ratio set the thread waits rather than make
+    more than max_ratio updates per environment step. The losses train
+    returns are kept for take_losses(), so reporting stays on the step loop.
+    Other work that fits agent.model (a warm-start pretrain) goes through
+    call(), which runs it on the learner thread between updates.
+    """
+
+    def __init__(self, agent, train, acting_model, publish_every=10, max_ratio=None,
+                 queue_size=10000):
+        self.agent = agent
+        self.train = train
+        self.acting_model = acting_model
+        self.acting_model.set_weights(agent.model.get_weights())
+        self.publish_every = publish_every
+        self.max_ratio = max_ratio
+        self.transitions = queue.Queue(queue_size)
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.weights = None
+        self.steps = 0
+        self.updates = 0
+        self.losses = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.learn)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def push(self, status):
+        self.transitions.put(status)
+        self.steps += 1
+
+    def call(self, function):
+        """Run function() on the learner thread, publish the weights and return its result."""
+        done = threading.Event()
+        result = []
+        self.jobs.put((function, result, done))
+        done.wait()
+        value, error = result
+        if error is not None:
+            raise error
+        return value
+
+    def predict(self, canvas):
+        return self.acting_model.predict(canvas)[0]
+
+    def refresh(self):
+        """Load the newest published weights into the acting model, if any."""
+        with self.lock:
+            weights, self.weights = self.weights, None
+        if weights is not None:
+            self.acting_model.set_weights(weights)
+
+    def take_losses(self):
+        """Losses of the updates since the last call."""
+        with self.lock:
+            losses, self.losses = self.losses, []
+        return losses
+
+    def ratio(self):
+        """Gradient updates per environment step so far."""
+        return self.updates / float(max(1, self.steps))
+
+    def run_jobs(self):
+        while True:
+            try:
+                function, result, done = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result.extend([function(), None])
+            except Exception as error:
+                result.extend([None, error])
+            weights = self.agent.model.get_weights()
+            with self.lock:
+                self.weights = weights
+            done.set()
+
+    def learn(self):
+        while not self.stopped.is_set():
+            self.run_jobs()
+            try:
+                # Block only while there is nothing to train on
+                self.agent.memorize(self.transitions.get(len(self.agent.memory) == 0, 0.1))
+                while True:
+                    self.agent.memorize(self.transitions.get_nowait())
+            except queue.Empty:
+                pass
+            if len(self.agent.memory) == 0:
+                continue
+            if self.max_ratio is not None and self.updates >= self.max_ratio * self.steps:
+                time.sleep(0.001)
+                continue
+
+            loss = self.train(self.updates)
+            self.updates += 1
+            if loss is not None:
+                with self.lock:
+                    self.losses.append(loss)
+            if self.updates % self.publish_every == 0:
+                weights = self.agent.model.get_weights()
+                with self.lock:
+                    self.weights = weights
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
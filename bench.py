@@ -0,0 +1,552 @@
+from __future__ import print_function
+import os
+import json
+import platform
+import shutil
+import tempfile
+import random
+import subprocess
+import sys
+import threading
+import time
+import timeit
+from collections import deque
+import numpy as np
+from maze_env import MazeEnv, SimulatedAgentHost, AIR, LAND, TARGET, MAP_LENGTH, MAP_WIDTH
+from grid_decoder import decode_grid, decode_tiles
+from replay import ReplayMemory, SumTree
+from qtable import QTable, QTableLog
+from n_step import DiscountedWindow
+from inference_server import InferenceServer
+from numpy_net import NumpyNet
+from trajectory import TrajectoryWriter, Trajectories, shuffled_batches
+
+# Every measurement of this run, written out by write_results
+results = []
+
+
+def record(name, value, unit, spread=0.0, **params):
+    """Keep one measurement; spread is the relative spread of the runs it is the best of."""
+    results.append(dict(name=name, value=value, unit=unit, spread=spread, params=params))
+    return value
+
+
+def quiet(func, *args, **kwargs):
+    """Call func with its per-step prints sent to os.devnull."""
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sys.stdout = stdout
+
+
+def decode_grid_loop(grid):
+    """The per-cell loop the agents used before grid_decoder, kept as a reference."""
+    maze = np.zeros((MAP_LENGTH, MAP_WIDTH))
+    position = [-1, -1]
+    target = [-1, -1]
+    boundary = [-1, -1, -1, -1]
+    for i in range(len(grid)):
+        if grid[i] == "redstone_block":
+            maze[i % MAP_WIDTH][i // MAP_WIDTH] = TARGET
+            target = [i % MAP_WIDTH, i // MAP_WIDTH]
+        elif grid[i] == "stone":
+            maze[i % MAP_WIDTH][i // MAP_WIDTH] = AIR
+        elif grid[i] == "diamond_block":
+            maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
+        elif grid[i] == "emerald_block":
+            position = [i % MAP_WIDTH, i // MAP_WIDTH]
+            maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
+        else:
+            continue
+        if boundary[0] == -1:
+            boundary[0] = i % MAP_WIDTH
+            boundary[1] = i // MAP_WIDTH
+        boundary[2] = i % MAP_WIDTH
+        boundary[3] = i // MAP_WIDTH
+    return maze, position, target, boundary
+
+
+def best_of(func, number, repeat=5):
+    """Best wall time per call of func over repeat runs, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def best_run(func, repeat=3, rate=False):
+    """Best of repeat calls of func, which returns one measurement, and their relative spread.
+
+    The best is the lowest value, or the highest when func returns a rate.
+    """
+    values = [func() for _ in range(repeat)]
+    best = max(values) if rate else min(values)
+    return best, (max(values) - min(values)) / best if best else 0.0
+
+
+def bench_decode(sizes=(4, 7, 10), number=2000):
+    for size in sizes:
+        grid = MazeEnv(size=size, seed=0).reset()
+        maze, start, target, boundary = decode_grid(grid)
+        reference = decode_grid_loop(grid)
+        assert (maze == reference[0]).all() and [start, target, boundary] == list(reference[1:])
+
+        loop = record('decode.loop', best_of(lambda: decode_grid_loop(grid), number), 's', size=size)
+        table = record('decode', best_of(lambda: decode_grid(grid), number), 's', size=size)
+        uncached = record('decode.uncached', best_of(lambda: decode_tiles(grid), number), 's', size=size)
+        print("floorAll decode, size %d: loop %.1f us, uncached %.1f us, cached %.1f us (%.1fx)"
+              % (size, loop * 1e6, uncached * 1e6, table * 1e6, loop / table))
+
+
+def bench_sum_tree(size=10 ** 6, batch_size=32, number=200):
+    tree = SumTree(size)
+    tree.update(np.arange(size), np.random.random(size))
+    rows = np.random.randint(size, size=batch_size)
+    errors = np.random.random(batch_size)
+
+    sample = best_of(lambda: tree.find(np.random.random(batch_size) * tree.total()), number)
+    update = best_of(lambda: tree.update(rows, errors), number)
+    record('sum_tree.sample', sample, 's', size=size, batch_size=batch_size)
+    record('sum_tree.update', update, 's', size=size, batch_size=batch_size)
+    print("sum tree, %d entries: sample %.0f/s, update %.0f/s (batches of %d)"
+          % (size, batch_size / sample, batch_size / update, batch_size))
+
+
+def bench_checkpoint(updates=20, number=200):
+    """Per-episode checkpoint: rewriting the table vs appending its updates to the log."""
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'table')
+        log = QTableLog.open(filename, compact_every=10 ** 9)
+
+        def episode():
+            for i in range(updates):
+                log.record(i % MAP_WIDTH, i // MAP_WIDTH, i % 4, 1.0)
+            log.flush()
+
+        snapshot = best_of(lambda: QTable.save(log.q_table, filename), number)
+        logged = best_of(episode, number)
+        log.close()
+        record('checkpoint.snapshot', snapshot, 's', updates=updates)
+        record('checkpoint.log', logged, 's', updates=updates)
+        print("checkpoint, %d updates/episode: snapshot %.1f us, log %.1f us"
+              % (updates, snapshot * 1e6, logged * 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def play_transcript(tabular, update, window, episodes):
+    """Feed recorded episodes through the n-step schedule of Tabular.play."""
+    for episode in episodes:
+        S, A, R = deque([episode[0][0]]), deque([episode[0][1]]), window(tabular.gamma)
+        R.append(0)
+        T = sys.maxsize
+        for t in range(sys.maxsize):
+            if t < T:
+                s, a, reward = episode[t + 1]
+                R.append(reward)
+                if s is None:
+                    T = t + 1
+                    S.append(None)
+                else:
+                    S.append(s)
+                    A.append(a)
+            tau = t - tabular.negative_n + 1
+            if tau >= 0:
+                update(tabular, tau, S, A, R, T)
+            if tau == T - 1:
+                while len(S) > 1:
+                    tau = tau + 1
+                    update(tabular, tau, S, A, R, T)
+                break
+
+
+def bench_n_step(windows=(1, 5, 50, 300), number=50):
+    """Check the rolling n-step return against the summed one and time both."""
+    from maze_tabular import Tabular
+    from test_n_step import update_q_table_sum, random_episodes
+    episodes = random_episodes(number, length=200)
+    steps = sum(len(episode) - 1 for episode in episodes)
+    for n in windows:
+        values, times = {}, []
+        for update, window in ((update_q_table_sum, lambda gamma: deque()),
+                               (Tabular.update_q_table, DiscountedWindow)):
+            def run():
+                tabular = Tabular(alpha=0.3, gamma=0.9)
+                tabular.negative_n = n
+                tabular.positive_n = n + 4
+                start = timeit.default_timer()
+                play_transcript(tabular, update, window, episodes)
+                elapsed = timeit.default_timer() - start
+                values[update] = tabular.q_table.values
+                return elapsed / steps
+            times.append(best_run(run))
+        summed, rolling = values[update_q_table_sum], values[Tabular.update_q_table]
+        if n == 1:
+            assert (summed == rolling).all()
+        assert np.allclose(summed, rolling, rtol=1e-5, atol=1e-5)
+        (summed_time, summed_spread), (rolling_time, rolling_spread) = times
+        record('n_step.sum', summed_time, 's', summed_spread, window=n)
+        record('n_step.rolling', rolling_time, 's', rolling_spread, window=n)
+        print("n-step return, window %d: sum %.1f us/update, rolling %.1f us/update"
+              % (n, summed_time * 1e6, rolling_time * 1e6))
+
+
+class OverheadModel(object):
+    """Stand-in for a Keras model: a fixed cost per predict call plus a 441x4 matmul."""
+
+    def __init__(self, overhead=0.001):
+        self.overhead = overhead
+        self.weights = np.random.RandomState(0).randn(MAP_LENGTH * MAP_WIDTH, 4).astype(np.float32)
+
+    def predict(self, canvases):
+        time.sleep(self.overhead)
+        return np.dot(canvases, self.weights)
+
+    def set_weights(self, weights):
+        self.weights = weights[0]
+
+
+def bench_inference(threads=16, calls=50):
+    """Aggregate single-canvas predictions/s from many threads, direct vs batched."""
+    model = OverheadModel()
+    canvases = np.random.randint(0, 5, (threads, MAP_LENGTH * MAP_WIDTH)).astype(np.float32)
+    server = InferenceServer(model).start()
+
+    def run(predict):
+        errors = []
+
+        def caller(i):
+            try:
+                for _ in range(calls):
+                    row = predict(canvases[i:i + 1])
+                    # float32 rows of a batched matmul differ from the single-row one by ~1e-5
+                    assert np.allclose(row, np.dot(canvases[i:i + 1], model.weights),
+                                       rtol=1e-4, atol=1e-4)
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=caller, args=(i, )) for i in range(threads)]
+        start = timeit.default_timer()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = timeit.default_timer() - start
+        if errors:
+            raise errors[0]
+        return threads * calls / elapsed
+
+    lock = threading.Lock()
+
+    def direct(canvas):
+        with lock:  # a Keras model can't predict from several threads at once
+            return model.predict(canvas)
+
+    unbatched, unbatched_spread = best_run(lambda: run(direct), rate=True)
+    batched, batched_spread = best_run(lambda: run(server.predict), rate=True)
+    server.stop()
+    record('inference.direct', unbatched, 'calls/s', unbatched_spread, threads=threads)
+    record('inference.batched', batched, 'calls/s', batched_spread, threads=threads)
+    print("inference, %d threads: direct %.0f/s, batched %.0f/s (mean batch %.1f)"
+          % (threads, unbatched, batched, server.mean_batch()))
+
+
+def bench_numpy_net(weights="weights.h5", batch_size=64, number=2000):
+    """NumpyNet against Keras (or a float64 NumPy reference without Keras)."""
+    net = NumpyNet.from_h5(weights)
+    canvases = np.random.randint(0, 5, (batch_size, MAP_LENGTH * MAP_WIDTH)).astype(np.float32)
+    try:
+        from keras.models import Sequential
+        from keras.layers.core import Dense
+        from keras.layers.advanced_activations import PReLU
+    except ImportError:
+        model = None
+        w1, b1, alpha1, w2, b2, alpha2, w3, b3 = [w.astype(np.float64) for w in net.get_weights()]
+        h = np.dot(canvases, w1) + b1
+        h = np.maximum(h, 0) + alpha1 * np.minimum(h, 0)
+        h = np.dot(h, w2) + b2
+        h = np.maximum(h, 0) + alpha2 * np.minimum(h, 0)
+        expected = np.dot(h, w3) + b3
+    else:
+        model = Sequential()
+        model.add(Dense(MAP_LENGTH * MAP_WIDTH, input_shape=(MAP_LENGTH * MAP_WIDTH, )))
+        model.add(PReLU())
+        model.add(Dense(MAP_LENGTH * MAP_WIDTH))
+        model.add(PReLU())
+        model.add(Dense(4))
+        model.load_weights(weights)
+        expected = model.predict(canvases)
+    assert np.allclose(net.predict(canvases), expected, rtol=1e-4, atol=1e-3)
+
+    row = canvases[:1]
+    single = best_of(lambda: net.predict(row), number)
+    batch = best_of(lambda: net.predict(canvases), number // 10)
+    record('predict.numpy_net', single, 's', batch_size=1)
+    record('predict.numpy_net', batch, 's', batch_size=batch_size)
+    print("NumpyNet predict: 1 row %.1f us, %d rows %.1f us"
+          % (single * 1e6, batch_size, batch * 1e6))
+    if model is not None:
+        keras_single = record('predict.keras', best_of(lambda: model.predict(row), number // 10), 's',
+                              batch_size=1)
+        print("Keras predict: 1 row %.1f us (%.0fx)" % (keras_single * 1e6, keras_single / single))
+
+
+class NoSleep(object):
+    """The time module without sleep, to drop a module's fixed waits from a timing."""
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        pass
+
+
+def bench_tabular_run(sizes=(4, 7, 10), episodes=20, step_delay=0.0):
+    """Tabular.run through a SimulatedAgentHost, and Tabular.run_env, in steps/s.
+
+    The 0.1 s Tabular.initialize sleeps before reading each maze is skipped,
+    so Tabular.run is timed on the agent's loop and the host's step_delay;
+    malmo_sync's polling still sleeps as it would against a client.
+    """
+    import maze_tabular
+    from maze_tabular import Tabular
+
+    def steps_per_second(name, size):
+        random.seed(0)
+        env = MazeEnv(size=size, seed=0)
+        host = SimulatedAgentHost(env, step_delay)
+        tabular = Tabular(epsilon=0.1)
+        start = timeit.default_timer()
+        for _ in range(episodes if name == 'run' else 50 * episodes):
+            if name == 'run':
+                host.start_mission()
+                tabular.run(host)
+            else:
+                tabular.run_env(env)
+        return sum(tabular.nums_steps) / (timeit.default_timer() - start)
+
+    verbose, maze_tabular.verbose = maze_tabular.verbose, False
+    maze_tabular.time = NoSleep()
+    try:
+        for size in sizes:
+            for name in ('run', 'run_env'):
+                rate, spread = best_run(lambda: steps_per_second(name, size), rate=True)
+                record('tabular.' + name, rate, 'steps/s', spread, size=size, step_delay=step_delay)
+                print("Tabular.%s, size %d: %.0f steps/s" % (name, size, rate))
+    finally:
+        maze_tabular.verbose = verbose
+        maze_tabular.time = time
+
+
+def random_transitions(number, seed=0):
+    rng = np.random.RandomState(seed)
+    return (rng.randint(0, 5, (number, MAP_LENGTH * MAP_WIDTH)), rng.randint(0, 4, number),
+            rng.choice([-1, 100, -50], number), rng.randint(0, 5, (number, MAP_LENGTH * MAP_WIDTH)),
+            rng.random_sample(number) < 0.1)
+
+
+def bench_replay(batch_sizes=(5, 32, 128), memory_lengths=(1000, 50000), number=200):
+    """Minibatch sampling from ReplayMemory, the part of iKun.train before the model."""
+    for memory_length in memory_lengths:
+        memory = ReplayMemory(memory_length)
+        memory.extend(*random_transitions(memory_length))
+        for batch_size in batch_sizes:
+            sample = record('replay.sample', best_of(lambda: memory.sample(batch_size), number), 's',
+                            batch_size=batch_size, memory_length=memory_length)
+            print("replay sample, memory %d, batch %d: %.1f us"
+                  % (memory_length, batch_size, sample * 1e6))
+
+
+def after_state_memory(agent, number, seed=0):
+    """Fill a maze3.iKun memory with random (position, after-state) transitions."""
+    rng = random.Random(seed)
+    for _ in range(number):
+        x, z = rng.randint(0, MAP_LENGTH - 1), rng.randint(0, MAP_WIDTH - 1)
+        after = [x + rng.choice([-1, 1]), z]
+        agent.memorize([[x, z], after, rng.choice([-1, 100, -50]), after,
+                        rng.sample(range(4), rng.randint(1, 4)), rng.random() < 0.1])
+
+
+def bench_train(batch_sizes=(5, 32), memory_lengths=(1000, 50000), number=20):
+    """iKun.train per minibatch and model.predict per canvas for maze, maze2 and maze3."""
+    try:
+        import keras
+    except ImportError:
+        print("iKun.train: skipped, Keras is not installed")
+        return
+    import maze
+    import maze2
+    import maze3
+    loss = []
+    for memory_length in memory_lengths:
+        transitions = random_transitions(memory_length)
+        agents = []
+        for module in (maze, maze2):
+            agent = module.iKun(module.build_model('weights'), memory_length=memory_length)
+            agent.memory.extend(*transitions)
+            agents.append((module.__name__, agent, transitions[0][:1].astype(np.float32)))
+        agent = maze3.iKun(maze3.build_model(None), memory_length=memory_length)
+        after_state_memory(agent, memory_length)
+        agents.append(('maze3', agent, np.array([[[10, 10], [10, 11]]])))
+
+        for name, agent, row in agents:
+            for batch_size in batch_sizes:
+                if name == 'maze':
+                    train = lambda: agent.train(batch_size)
+                else:
+                    train = lambda: agent.train(0, loss, batch_size)
+                latency = record('train.' + name, best_of(lambda: quiet(train), number, repeat=3), 's',
+                                 batch_size=batch_size, memory_length=memory_length)
+                print("%s iKun.train, memory %d, batch %d: %.1f ms"
+                      % (name, memory_length, batch_size, latency * 1e3))
+            predict = record('predict.' + name, best_of(lambda: agent.model.predict(row), number), 's',
+                             batch_size=1, memory_length=memory_length)
+            print("%s predict: %.1f ms" % (name, predict * 1e3))
+
+
+def bench_trajectories(steps=10 ** 6, episode_length=30, batch_size=4096):
+    """Record steps to a TrajectoryWriter, then open them and read one shuffled epoch."""
+    directory = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        layout = rng.randint(0, 4, (MAP_LENGTH, MAP_WIDTH))
+        positions = rng.randint(0, MAP_LENGTH, (steps, 2)).tolist()
+        actions = rng.randint(0, 4, steps).tolist()
+
+        def write():
+            if os.path.exists(directory):
+                shutil.rmtree(directory)
+            writer = TrajectoryWriter(directory)
+            start = timeit.default_timer()
+            for i in range(steps):
+                if i % episode_length == 0:
+                    writer.begin_episode(layout)
+                writer.record(positions[i], actions[i], -1.0, i % episode_length == episode_length - 1)
+            writer.close()
+            return (timeit.default_timer() - start) / steps
+
+        def load():
+            start = timeit.default_timer()
+            Trajectories(directory).episodes(np.arange(1))
+            return timeit.default_timer() - start
+
+        def epoch():
+            start = timeit.default_timer()
+            rows = sum(len(batch[1]) for batch in shuffled_batches(trajectories, batch_size, seed=0))
+            assert rows == steps
+            return timeit.default_timer() - start
+
+        write, spread = best_run(write)
+        record('trajectory.write', write, 's', spread, steps=steps)
+        size = record('trajectory.size', sum(os.path.getsize(os.path.join(directory, name))
+                                             for name in os.listdir(directory)), 'bytes', steps=steps)
+        load, spread = best_run(load)
+        record('trajectory.open', load, 's', spread, steps=steps)
+        trajectories = Trajectories(directory)
+        epoch, spread = best_run(epoch)
+        record('trajectory.epoch', epoch, 's', spread, steps=steps, batch_size=batch_size)
+        print("trajectories, %d steps: write %.1f us/step, %.1f MB, open %.3f s, shuffled epoch %.2f s"
+              % (steps, write * 1e6, size / 1e6, load, epoch))
+        del trajectories
+    finally:
+        shutil.rmtree(directory)
+
+
+ENTRY_POINTS = ['maze', 'maze2', 'maze3', 'maze_tabular', 'test', 'singleClientTest']
+HEAVY_MODULES = ['keras', 'tensorflow', 'matplotlib', 'PIL', 'MalmoPython']
+
+# Import the script, then build its model as its training paths must (nan without
+# Keras or a build_model)
+STARTUP = """
+import sys, timeit
+start = timeit.default_timer()
+import %s as script
+print(timeit.default_timer() - start)
+print(' '.join(name for name in %r if name in sys.modules))
+ready = float('nan')
+if hasattr(script, 'build_model'):
+    try:
+        script.build_model('weights')
+        ready = timeit.default_timer() - start
+    except ImportError:
+        pass
+print(ready)
+"""
+
+
+def bench_startup(entry_points=ENTRY_POINTS, repeat=3):
+    """Time each script's entry path in a fresh interpreter.
+
+    startup is the import alone, with the heavy modules it loaded;
+    startup.ready adds the build_model call every training path of the DQN
+    scripts makes before its first step. It is skipped for scripts without
+    a build_model and when Keras is missing.
+    """
+    for name in entry_points:
+        imports, ready = [], []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', STARTUP % (name, HEAVY_MODULES)],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+            lines = output.decode('utf8').split('\n')
+            imports.append(float(lines[0]))
+            ready.append(float(lines[2]))
+        record('startup', min(imports), 's', entry_point=name)
+        print("startup %-16s %6.1f ms, heavy imports: %s"
+              % (name, min(imports) * 1e3, lines[1] or 'none'))
+        if not np.isnan(min(ready)):
+            record('startup.ready', min(ready), 's', entry_point=name)
+            print("startup %-16s %6.1f ms until ready to train" % (name, min(ready) * 1e3))
+
+
+def write_results(filename):
+    """Write results to filename as JSON, with the commit and versions they came from."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with open(filename, 'w') as outfile:
+        json.dump(dict(commit=commit, time=time.time(), python=platform.python_version(),
+                       numpy=np.__version__, machine=platform.machine(), results=results),
+                  outfile, indent=1, sort_keys=True)
+
+
+def compare_results(baseline, tolerance=0.2):
+    """Print every result that got worse than in the baseline file by more than noise.
+
+    The noise is tolerance, or the spread of the runs behind the two
+    measurements when that is larger.
+    """
+    with open(baseline, 'r') as infile:
+        old = dict((json.dumps([result['name'], result['params']], sort_keys=True), result)
+                   for result in json.load(infile)['results'])
+    for result in results:
+        before = old.get(json.dumps([result['name'], result['params']], sort_keys=True))
+        if before is None or not before['value'] or not result['value']:
+            continue
+        # Rates are better higher, times lower
+        ratio = result['value'] / before['value']
+        slower = 1 / ratio if result['unit'].endswith('/s') else ratio
+        noise = max(tolerance, before.get('spread', 0.0) + result['spread'])
+        if slower > 1 + noise:
+            print("regression: %s %s %.3g -> %.3g %s (%.2fx)"
+                  % (result['name'], result['params'], before['value'], result['value'],
+                     result['unit'], slower))
+
+
+if __name__ == '__main__':
+    # bench.py [results.json [baseline.json]]
+    bench_decode()
+    bench_sum_tree()
+    bench_checkpoint()
+    bench_n_step()
+    bench_replay()
+    bench_trajectories()
+    bench_tabular_run()
+    bench_train()
+    bench_inference()
+    bench_numpy_net()
+    bench_startup()
+    write_results(sys.argv[1] if len(sys.argv) > 1 else 'bench_results.json')
+    if len(sys.argv) > 2:
+        compare_results(sys.argv[2])
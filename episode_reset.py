@@ -0,0 +1,97 @@
+from __future__ import print_function
+import json
+import math
+import re
+import time
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+
+GOAL = 'goal'
+FALL = 'fall'
+
+QUIT_HANDLERS = re.compile(r'\s*<AgentQuitFromTouchingBlockType>.*?</AgentQuitFromTouchingBlockType>'
+                           r'|\s*<ServerQuitFromTimeUp[^>]*/>'
+                           r'|\s*<ServerQuitWhenAnyAgentFinishes\s*/>', re.S)
+
+
+def persistent_mission_xml(mission_xml):
+    """Strip the handlers that end a mission on a goal, a fall or a time-out.
+
+    MissionQuitCommands is added so PersistentMission can end the mission
+    itself when the maze changes, and ObservationFromFullStats (if missing)
+    so teleport can see where the agent is.
+    """
+    mission_xml = QUIT_HANDLERS.sub('', mission_xml)
+    if '<ObservationFromFullStats' not in mission_xml:
+        mission_xml = mission_xml.replace(
+            '</AgentHandlers>', '  <ObservationFromFullStats/>\n                </AgentHandlers>', 1)
+    return mission_xml.replace('<AgentHandlers>', '<AgentHandlers>\n                    <MissionQuitCommands/>', 1)
+
+
+def episode_outcome(world_state, end_block='redstone_block', gap_blocks=('stone', 'air')):
+    """Return GOAL, FALL or None from the newest floorAll observation.
+
+    The centre of the grid is the block under the agent, so standing on the
+    end block is a goal and standing on a gap (or over air) is a fall.
+    """
+    if not world_state.observations:
+        return None
+    grid = json.loads(world_state.observations[-1].text).get(u'floorAll')
+    if not grid:
+        return None
+    below = grid[len(grid) // 2]
+    if below == end_block:
+        return GOAL
+    if below in gap_blocks:
+        return FALL
+    return None
+
+
+def standing_on(world_state, x, z):
+    """True if the newest observation with full stats (XPos, ZPos) is over block (x, z)."""
+    for observation in reversed(world_state.observations):
+        stats = json.loads(observation.text)
+        if u'XPos' in stats and u'ZPos' in stats:
+            return int(math.floor(stats[u'XPos'])) == x and int(math.floor(stats[u'ZPos'])) == z
+    return False
+
+
+def teleport(agent_host, x, z, height=71, timeout=1.0):
+    """Teleport to block (x, z) and wait until an observation shows the agent there.
+
+    The mission needs ObservationFromFullStats; observations from before
+    the tp (the cell an episode ended on) never pass the check.
+    """
+    agent_host.sendCommand("tp " + str(x + 0.5) + " " + str(height) + " " + str(z + 0.5))
+    deadline = time.time() + timeout
+    while True:
+        world_state = wait_for_world_state(agent_host, observation=True, reward=False,
+                                           timeout=max(0, deadline - time.time()))
+        if not world_state.is_mission_running or time.time() >= deadline:
+            return world_state
+        if standing_on(world_state, x, z):
+            return world_state
+
+
+class PersistentMission(object):
+    """Keep one mission alive across episodes.
+
+    start(seed) is whatever the script uses to start a mission built from
+    persistent_mission_xml; it only runs when the maze seed changes or the
+    mission has died, and every other episode is reset with teleport().
+    """
+
+    def __init__(self, agent_host, start):
+        self.agent_host = agent_host
+        self.start = start
+        self.seed = None
+
+    def begin(self, seed):
+        """Make sure a mission for seed is running; True if it was (re)started."""
+        if self.agent_host.getWorldState().is_mission_running:
+            if self.seed == seed:
+                return False
+            self.agent_host.sendCommand("quit")
+            wait_for_mission_end(self.agent_host)
+        self.start(seed)
+        self.seed = seed
+        return True
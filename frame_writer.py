@@ -0,0 +1,94 @@
+from __future__ import print_function
+import os
+import threading
+import numpy as np
+from startup import LazyModule
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+Image = LazyModule('PIL.Image')
+
+NEWEST = 'newest'
+OLDEST = 'oldest'
+
+
+class FrameWriter(object):
+    """Save video frames from background threads so the step loop never waits on disk.
+
+    put() copies the frame's pixels and returns straight away. Worker
+    threads turn queued frames into PNGs (PIL's compression releases the
+    GIL) or, with container set, append the raw RGB bytes to that one file
+    (read it back with read_raw_frames). At most max_pending frames wait in
+    the queue; when it is full the frame being put (drop=NEWEST) or the
+    oldest waiting one (drop=OLDEST) is dropped and counted in dropped.
+    """
+
+    def __init__(self, directory='.', workers=2, max_pending=8, drop=NEWEST, container=None):
+        self.directory = directory
+        self.drop = drop
+        self.frames = queue.Queue(max_pending)
+        self.dropped = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        self.container = None
+        if container is not None:
+            self.container = open(os.path.join(directory, container), 'ab')
+            workers = 1  # frames must reach the container in order
+        self.workers = [threading.Thread(target=self.work) for _ in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def put(self, frame, filename):
+        """Queue a Malmo TimestampedVideoFrame to be written as filename."""
+        item = (frame.width, frame.height, bytes(frame.pixels), filename)
+        try:
+            self.frames.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        if self.drop == OLDEST:
+            try:
+                self.frames.get_nowait()
+                self.frames.task_done()
+            except queue.Empty:
+                pass
+            try:
+                self.frames.put_nowait(item)
+            except queue.Full:
+                pass
+        self.dropped += 1
+        return False
+
+    def work(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                self.frames.task_done()
+                return
+            width, height, pixels, filename = item
+            if self.container is not None:
+                self.container.write(pixels)
+            else:
+                Image.frombytes('RGB', (width, height), pixels).save(os.path.join(self.directory, filename))
+            with self.lock:
+                self.written += 1
+            self.frames.task_done()
+
+    def close(self):
+        """Write everything still queued, then stop the workers."""
+        for _ in self.workers:
+            self.frames.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.container is not None:
+            self.container.close()
+
+
+def read_raw_frames(filename, width=1280, height=960):
+    """Memory-map a FrameWriter container as an (n, height, width, 3) uint8 array."""
+    frames = np.memmap(filename, dtype=np.uint8, mode='r')
+    return frames.reshape((-1, height, width, 3))
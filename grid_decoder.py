@@ -0,0 +1,68 @@
+from __future__ import print_function
+import numpy as np
+from maze_env import UNKNOWN, AIR, LAND, TARGET, MAP_WIDTH
+
+# Tile codes of the lookup table; anything not listed (air, ...) is NONE
+NONE = 0
+GAP = 1
+PATH = 2
+END = 3
+START = 4
+
+BLOCK_TILES = {
+    'redstone_block': END,
+    'stone': GAP,
+    'diamond_block': PATH,
+    'emerald_block': START,
+}
+
+# Tile -> maze code, indexed by tile
+TILE_CODES = np.array([UNKNOWN, AIR, LAND, TARGET, LAND], dtype=np.int8)
+
+# Decoded layouts by floorAll grid; the agents see the same few grids again every episode
+CACHE_SIZE = 256
+decoded = {}
+
+
+def decode_grid(grid, block_tiles=BLOCK_TILES, width=MAP_WIDTH):
+    """Decode a floorAll observation through the block lookup table.
+
+    Returns (maze, start, target, boundary): maze is an int8 array indexed
+    [x][z], start and target are [x, z] of the start and end blocks ([-1, -1]
+    if absent) and boundary is [x, z] of the first and last known block in
+    floorAll order, as the agents' own loops tracked it. Results for the
+    default table are cached by grid, so a repeated grid costs a tuple hash
+    and a copy rather than a lookup per cell.
+    """
+    if block_tiles is not BLOCK_TILES:
+        return decode_tiles(grid, block_tiles, width)
+    key = (tuple(grid), width)
+    result = decoded.get(key)
+    if result is None:
+        if len(decoded) >= CACHE_SIZE:
+            decoded.clear()
+        result = decoded[key] = decode_tiles(grid, block_tiles, width)
+    maze, start, target, boundary = result
+    return maze.copy(), list(start), list(target), list(boundary)
+
+def decode_tiles(grid, block_tiles=BLOCK_TILES, width=MAP_WIDTH):
+    """decode_grid without the cache."""
+    tiles = np.fromiter(map(block_tiles.get, grid, [NONE] * len(grid)), np.int8, len(grid))
+    maze = TILE_CODES[tiles].reshape((-1, width)).transpose()
+
+    known = np.flatnonzero(tiles)
+    if len(known):
+        boundary = [int(known[0] % width), int(known[0] // width),
+                    int(known[-1] % width), int(known[-1] // width)]
+    else:
+        boundary = [-1, -1, -1, -1]
+    return maze, locate(tiles, START, width), locate(tiles, END, width), boundary
+
+
+def locate(tiles, tile, width=MAP_WIDTH):
+    """[x, z] of the last cell holding tile, or [-1, -1]."""
+    found = np.flatnonzero(tiles == tile)
+    if not len(found):
+        return [-1, -1]
+    i = int(found[-1])
+    return [i % width, i // width]
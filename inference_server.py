@@ -0,0 +1,162 @@
+from __future__ import print_function
+import threading
+import time
+import numpy as np
+from actor_learner import processes
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Reply(object):
+    """Slot a calling thread waits on for its rows."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+        self.event.set()
+
+    def get(self):
+        self.event.wait()
+        return self.value
+
+
+class RemoteReply(object):
+    def __init__(self, responses):
+        self.responses = responses
+
+    def set(self, value):
+        self.responses.put(value)
+
+
+class RemoteModel(object):
+    """Stands in for the model in another process; predict() goes through the server.
+
+    The server holds the weights, so set_weights is a no-op here.
+    """
+
+    def __init__(self, requests, responses, index):
+        self.requests = requests
+        self.responses = responses
+        self.index = index
+
+    def predict(self, canvases, **kwargs):
+        self.requests.put((self.index, np.asarray(canvases, dtype=np.float32)))
+        result = self.responses.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def set_weights(self, weights):
+        pass
+
+
+class InferenceServer(object):
+    """Gather predict calls from many threads or processes into micro-batches.
+
+    A batch is sent to model.predict once it holds max_batch rows or
+    max_wait seconds after its first request, whichever comes first, and
+    each caller gets back the rows of its own request. Threads call
+    predict() directly; processes use the RemoteModel from client(i), one
+    per process, i < clients. Only the server thread touches model, and
+    set_weights() is applied between batches.
+    """
+
+    def __init__(self, model, max_batch=64, max_wait=0.002, clients=0):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.remote_requests = processes.Queue()
+        self.responses = [processes.Queue() for _ in range(clients)]
+        self.lock = threading.Lock()
+        self.weights = None
+        self.batches = 0
+        self.rows = 0
+        self.threads = [threading.Thread(target=self.serve)]
+        if clients:
+            self.threads.append(threading.Thread(target=self.forward))
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def predict(self, canvases, **kwargs):
+        reply = Reply()
+        self.requests.put((np.asarray(canvases, dtype=np.float32), reply))
+        result = reply.get()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def client(self, index):
+        return RemoteModel(self.remote_requests, self.responses[index], index)
+
+    def set_weights(self, weights):
+        with self.lock:
+            self.weights = weights
+
+    def mean_batch(self):
+        """Average rows per model.predict call so far."""
+        return self.rows / float(max(1, self.batches))
+
+    def forward(self):
+        while True:
+            request = self.remote_requests.get()
+            if request is None:
+                return
+            index, canvases = request
+            self.requests.put((canvases, RemoteReply(self.responses[index])))
+
+    def serve(self):
+        stopping = False
+        while not stopping:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            rows = len(request[0])
+            deadline = time.time() + self.max_wait
+            while rows < self.max_batch:
+                try:
+                    request = self.requests.get(True, max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                rows += len(request[0])
+
+            with self.lock:
+                weights, self.weights = self.weights, None
+            if weights is not None:
+                self.model.set_weights(weights)
+            try:
+                q = self.model.predict(np.concatenate([canvases for canvases, _ in batch]))
+            except Exception as e:
+                q = None
+                for _, reply in batch:
+                    reply.set(e)
+            if q is not None:
+                start = 0
+                for canvases, reply in batch:
+                    reply.set(q[start:start + len(canvases)])
+                    start += len(canvases)
+            self.batches += 1
+            self.rows += rows
+
+    def stop(self):
+        self.requests.put(None)
+        if len(self.threads) > 1:
+            self.remote_requests.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,72 @@
+from __future__ import print_function
+import time
+
+
+class StepState(object):
+    """World state gathered over several getWorldState() polls.
+
+    Malmo hands out observations, rewards and frames only once, so everything
+    seen while waiting is merged here. Exposes the attributes the agents read
+    from a MalmoPython.WorldState.
+    """
+
+    def __init__(self):
+        self.is_mission_running = True
+        self.has_mission_begun = True
+        self.observations = []
+        self.rewards = []
+        self.video_frames = []
+        self.errors = []
+        self.number_of_observations_since_last_state = 0
+
+    def add(self, world_state):
+        self.is_mission_running = world_state.is_mission_running
+        self.has_mission_begun = world_state.has_mission_begun
+        self.observations.extend(world_state.observations)
+        self.rewards.extend(world_state.rewards)
+        self.video_frames.extend(world_state.video_frames)
+        self.errors.extend(world_state.errors)
+        self.number_of_observations_since_last_state += \
+            world_state.number_of_observations_since_last_state
+
+
+def wait_for_world_state(agent_host, observation=False, reward=True, video=False,
+                         timeout=2.0, backoff=0.001, max_backoff=0.02):
+    """Wait for the response to the last command instead of sleeping blindly.
+
+    Polls agent_host until every requested kind of data (an observation, a
+    reward, a video frame) has arrived, the mission stops running or timeout
+    seconds pass. Every mission rewards each command it handles
+    (RewardForSendingCommand), so by default the wait ends on that reward.
+    The poll interval starts at backoff and doubles up to max_backoff so the
+    wait returns within milliseconds of the client without spinning a core.
+    Returns a StepState.
+    """
+    state = StepState()
+    deadline = time.time() + timeout
+    delay = backoff
+    while True:
+        state.add(agent_host.getWorldState())
+        if not state.is_mission_running:
+            return state
+        if (not observation or state.observations) and \
+                (not reward or state.rewards) and \
+                (not video or state.video_frames):
+            return state
+        if time.time() >= deadline:
+            return state
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+
+def wait_for_mission_end(agent_host, timeout=10.0, backoff=0.001, max_backoff=0.05):
+    """Wait until the mission stops running; returns the merged StepState."""
+    state = StepState()
+    deadline = time.time() + timeout
+    delay = backoff
+    while True:
+        state.add(agent_host.getWorldState())
+        if not state.is_mission_running or time.time() >= deadline:
+            return state
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
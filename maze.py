@@ -1,11 +1,18 @@
 from __future__ import print_function
 import os, sys, time, datetime, json, random
 import numpy as np
-from keras.models import Sequential
-from keras.layers.core import Dense, Activation
-from keras.optimizers import SGD , Adam, RMSprop
-from keras.layers.advanced_activations import PReLU
-import MalmoPython
+from startup import LazyModule, save_model_json
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+from episode_reset import episode_outcome, GOAL
+from replay import ReplayMemory, PrioritizedReplayMemory
+from grid_decoder import decode_grid
+from async_learner import BackgroundLearner
+from numpy_net import NumpyNet, NumpyPolicy
+from mission_spec import mission_spec
+from phase_timer import PhaseTimer
+
+# Keras is imported by build_model and the clone_model callers
+MalmoPython = LazyModule('MalmoPython')
 
 ACTIONS = ['movenorth 1', 'movesouth 1', 'movewest 1', 'moveeast 1']
 
@@ -19,75 +26,24 @@ LAND = 2
 TARGET = 3
 SELF = 4
 
-
-def GetMissionXML():
-    return '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-            <Mission xmlns="http://ProjectMalmo.microsoft.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-
-              <About>
-                <Summary>Hello world!</Summary>
-              </About>
-
-            <ServerSection>
-              <ServerInitialConditions>
-                <Time>
-                    <StartTime>1000</StartTime>
-                    <AllowPassageOfTime>false</AllowPassageOfTime>
-                </Time>
-                <Weather>clear</Weather>
-              </ServerInitialConditions>
-              <ServerHandlers>
-                  <FlatWorldGenerator generatorString="3;7,44*49,73,35:1,159:4,95:13,35:13,159:11,95:10,159:14,159:6,35:6,95:6;12;"/>
-                  <DrawingDecorator>
-                    <DrawSphere x="-27" y="70" z="0" radius="30" type="air"/>
-                  </DrawingDecorator>
-                  <MazeDecorator>
-                    <Seed>0</Seed>
-                    <SizeAndPosition width="''' + str(SIZE) + '''" length="''' + str(SIZE) + '''" height="10" xOrigin="-32" yOrigin="69" zOrigin="-5"/>
-                    <StartBlock type="emerald_block" fixedToEdge="true"/>
-                    <EndBlock type="redstone_block" fixedToEdge="true"/>
-                    <PathBlock type="diamond_block"/>
-                    <FloorBlock type="air"/>
-                    <GapBlock type="air"/>
-                    <GapProbability>''' + str(0.5) + '''</GapProbability>
-                    <AllowDiagonalMovement>false</AllowDiagonalMovement>
-                  </MazeDecorator>
-                  <ServerQuitFromTimeUp timeLimitMs="10000"/>
-                  <ServerQuitWhenAnyAgentFinishes/>
-                </ServerHandlers>
-              </ServerSection>
-
-              <AgentSection mode="Survival">
-                <Name>CS175AwesomeMazeBot</Name>
-                <AgentStart>
-                    <Placement x="0.5" y="56.0" z="0.5" yaw="0"/>
-                </AgentStart>
-                <AgentHandlers>
-                    <DiscreteMovementCommands/>
-                    <RewardForSendingCommand reward="-1"/>
-                    <RewardForTouchingBlockType>
-                      <Block reward="100" type="redstone_block" behaviour="onceOnly"/>
-                    </RewardForTouchingBlockType>
-                    <AgentQuitFromTouchingBlockType>
-                        <Block type="redstone_block"/>
-                        <Block type="obsidian"/>
-                        <Block type="redstone_ore"/>
-                        <Block type="redstone_ore"/>
-                    </AgentQuitFromTouchingBlockType>
-                    <ObservationFromGrid>
-                      <Grid name="floorAll">
-                        <min x="-10" y="-1" z="-10"/>
-                        <max x="10" y="-1" z="10"/>
-                      </Grid>
-                  </ObservationFromGrid>
-                  <ObservationFromFullStats/>
-                </AgentHandlers>
-              </AgentSection>
-            </Mission>'''
+# Headless, batched and actor training are in maze2.py only: maze_env.BatchMazeEnv
+# and actor_learner.ClientMazeEnv build maze2's canvases, not Maze.get_canvas below
+MISSION = dict(size=SIZE, gap_probability=0.5, gap_block='air', absolute_movement=False, full_stats=True,
+               quit_blocks=('redstone_block', 'obsidian', 'redstone_ore', 'redstone_ore'))
+# Train in a background thread while Maze.run keeps acting
+async_learning = False
+# Act with a numpy_net.NumpyNet copy of the network instead of Keras: in Maze.run
+# (reloaded after each train) and the learner thread's acting copy
+numpy_inference = False
+# Time each phase of Maze.run and append per-episode percentiles to this file
+phase_metrics = None
 
 
 def build_model(load_weight_filename, lr=0.001):
     global ACTIONS
+    from keras.models import Sequential
+    from keras.layers.core import Dense
+    from keras.layers.advanced_activations import PReLU
     model = Sequential()
     model.add(Dense(MAP_LENGTH * MAP_WIDTH, input_shape=(MAP_LENGTH * MAP_WIDTH, )))
     model.add(PReLU())
@@ -101,44 +57,76 @@ def build_model(load_weight_filename, lr=0.001):
 
 class iKun(object):
 
-    def __init__(self, model, memory_length=20, gamma=0.95, epsilon=0):
+    def __init__(self, model, memory_length=50000, gamma=0.95, epsilon=0, memory_file=None,
+                 prioritized=False, target_sync=0, tau=None, double_dqn=False):
         self.model = model
-        self.memory = []
+        # Bootstrap from a separate target network, copied from the online
+        # model every target_sync training steps or Polyak-averaged with tau
+        self.target_model = None
+        if double_dqn and not (target_sync or tau):
+            raise ValueError("double_dqn needs a target network: set target_sync or tau")
+        if target_sync or tau:
+            from keras.models import clone_model
+            self.target_model = clone_model(model)
+            self.target_model.set_weights(model.get_weights())
+        self.target_sync = target_sync
+        self.tau = tau
+        self.double_dqn = double_dqn
+        self.metrics = {'train_steps': 0, 'target_syncs': 0, 'mean_q': 0.0, 'loss': 0.0}
+        if prioritized:
+            self.memory = PrioritizedReplayMemory(memory_length, MAP_LENGTH * MAP_WIDTH, memory_file)
+        else:
+            self.memory = ReplayMemory(memory_length, MAP_LENGTH * MAP_WIDTH, memory_file)
         self.memory_length = memory_length
         self.gamma = gamma
         self.epsilon = epsilon
 
     def memorize(self, status):
-        self.memory.append(status)
-        if len(self.memory) > self.memory_length:
-            del self.memory[0]
+        self.memory.append(*status)
 
     def predict(self, canvas):
         return self.model.predict(canvas)[0]
 
     def train(self, batch_size=5):
-        global ACTIONS
-
-        env_size = MAP_LENGTH * MAP_WIDTH
-        mem_size = len(self.memory)
-        data_size = min(mem_size, batch_size)
-
-        inputs = np.zeros((data_size, env_size))
-        targets = np.zeros((data_size, len(ACTIONS)))
-
-        for i, j in enumerate(np.random.choice(range(mem_size), data_size, replace = False)):
-            canvas, action, reward, canvas_next, game_over = self.memory[j]
-            inputs[i] = canvas
-            targets[i] = self.predict(canvas)
-            print("targets[i]:", targets[i])
-            Q_sa = np.max(self.predict(canvas_next))
-            if game_over:
-                targets[i][action] = reward
+        rows, weights = self.memory.sample_rows(batch_size)
+        inputs, actions, rewards, canvas_next, game_over = self.memory.get(rows)
+        data_size = len(actions)
+
+        # One forward pass for the current and next canvases of the whole batch
+        q = self.model.predict(np.concatenate([inputs, canvas_next]))
+        targets = q[:data_size]
+        if self.target_model is None:
+            Q_sa = np.max(q[data_size:], axis=1)
+        else:
+            q_target = self.target_model.predict(canvas_next)
+            if self.double_dqn:
+                # The online model picks the next action, the target model values it
+                Q_sa = q_target[np.arange(data_size), np.argmax(q[data_size:], axis=1)]
             else:
-                targets[i][action] = reward + self.gamma * Q_sa
-
-        self.model.fit(inputs, targets, epochs=2, batch_size=5, verbose=0)
-        # print("loss:", self.model.evaluate(inputs, targets))
+                Q_sa = np.max(q_target, axis=1)
+        self.metrics['mean_q'] = float(np.mean(np.max(targets, axis=1)))
+        expected = np.where(game_over, rewards, rewards + self.gamma * Q_sa)
+        self.memory.update_priorities(rows, expected - targets[np.arange(data_size), actions])
+        targets[np.arange(data_size), actions] = expected
+
+        history = self.model.fit(inputs, targets, sample_weight=weights,
+                                 epochs=2, batch_size=5, verbose=0)
+        self.metrics['loss'] = history.history['loss'][-1]
+        self.metrics['train_steps'] += 1
+        self.sync_target()
+        return history.history['loss'][-1]
+
+    def sync_target(self):
+        if self.target_model is None:
+            return
+        if self.tau:
+            self.target_model.set_weights([
+                self.tau * online + (1 - self.tau) * target for online, target in
+                zip(self.model.get_weights(), self.target_model.get_weights())])
+            self.metrics['target_syncs'] += 1
+        elif self.metrics['train_steps'] % self.target_sync == 0:
+            self.target_model.set_weights(self.model.get_weights())
+            self.metrics['target_syncs'] += 1
 
 
 class Maze(object):
@@ -146,35 +134,40 @@ class Maze(object):
     def __init__(self, agent_host, agent):
         self.agent_host = agent_host
         self.maze = np.zeros((MAP_LENGTH, MAP_WIDTH))
-        self.position, self.target = self.get_position_target()
+        self.timer = PhaseTimer(phase_metrics)
+        # Read from the mission's observations by run
+        self.position, self.target = [-1, -1], [-1, -1]
         self.agent = agent
         self.reward = 0
+        # async_learner.BackgroundLearner that trains the agent, if any
+        self.learner = None
 
     def get_position_target(self):
+        """Start and end block in the newest floorAll observation.
+
+        Waits for the observation as long as the mission runs, so a slow
+        client never hands back the [-1, -1] of a missing block.
+        """
         global MAP_LENGTH, MAP_WIDTH
-        grid = -1
-        world_state = agent_host.getWorldState()
-        while world_state.is_mission_running:
-            time.sleep(0.1)
-            world_state = agent_host.getWorldState()
+        grid = None
+        while grid is None:
+            with self.timer.phase('wait'):
+                world_state = wait_for_world_state(self.agent_host, observation=True, reward=False)
             if len(world_state.errors) > 0:
                 raise AssertionError('Could not load grid.')
-
             if world_state.number_of_observations_since_last_state > 0:
                 msg = world_state.observations[-1].text
                 observations = json.loads(msg)
-                grid = observations.get(u'floorAll', 0)
-                break
+                grid = observations.get(u'floorAll')
+            elif not world_state.is_mission_running:
+                raise AssertionError('Mission ended before the grid was observed.')
 
-        position = [-1, -1]
-        target = [-1, -1]
-
-        if not grid == -1:
-            for i in range(len(grid)):
-                if grid[i] == "redstone_block":
-                    target = [i // MAP_WIDTH, i % MAP_WIDTH]
-                elif grid[i] == "emerald_block":
-                    position = [i // MAP_WIDTH, i % MAP_WIDTH]
+        with self.timer.phase('decode'):
+            _, start, end, _ = decode_grid(grid)
+        if -1 in start or -1 in end:
+            raise AssertionError('Start or end block not in the grid.')
+        position = [start[1], start[0]]
+        target = [end[1], end[0]]
 
         return [position, target]
 
@@ -187,7 +180,15 @@ class Maze(object):
 
     def run(self):
         global ACTIONS, LAND
+        self.position, self.target = self.get_position_target()
         canvas = self.get_canvas()
+        if self.learner is not None:
+            policy = self.learner
+        elif numpy_inference:
+            policy = NumpyPolicy(self.agent)
+        else:
+            policy = self.agent
+        timer = self.timer
 
         while True:
             self.position, self.target = self.get_position_target()
@@ -195,63 +196,105 @@ class Maze(object):
 
             prev_canvas = canvas
             reward = 0
-            rnd = random.random()
+            with timer.phase('act'):
+                rnd = random.random()
 
-            if rnd < self.agent.epsilon:
-                action = random.randint(0, 3)
-            else:
-                action = np.argmax(self.agent.predict(canvas))
+                if rnd < self.agent.epsilon:
+                    action = random.randint(0, 3)
+                else:
+                    action = np.argmax(policy.predict(canvas))
 
             print("action:", action)
-            agent_host.sendCommand(ACTIONS[action])
-            time.sleep(2)
-            world_state = self.agent_host.getWorldState()
-            game_over = False if world_state.is_mission_running else True
+            with timer.phase('send'):
+                agent_host.sendCommand(ACTIONS[action])
+            with timer.phase('wait'):
+                world_state = wait_for_world_state(self.agent_host, observation=True)
+            # Goal or fall from the block under the agent, as maze_tabular's Tabular.act
+            # decides from its decoded maze: the mission only stops some ticks later
+            outcome = episode_outcome(world_state)
+            game_over = outcome is not None or not world_state.is_mission_running
 
             # Update recognized maze
             current_reward = 0
             if len(world_state.rewards) > 0:
                 current_reward = world_state.rewards[-1].getValue()
-                if current_reward == 100:  # 100 for reaching target
-                    self.maze[self.position[0]][self.position[1]] = TARGET
-                elif current_reward == -1:  # -1 for each step
-                    self.maze[self.position[0]][self.position[1]] = LAND
-
-            if game_over:  # -20 for falling
+            if outcome == GOAL or current_reward >= 50:  # 100 for reaching target
+                self.maze[self.position[0]][self.position[1]] = TARGET
+                current_reward = 100
+                game_over = True
+            elif game_over:  # -20 for falling
                 self.maze[self.position[0]][self.position[1]] = AIR
                 current_reward = -20
+            elif current_reward == -1:  # -1 for each step
+                self.maze[self.position[0]][self.position[1]] = LAND
+            if game_over:
+                with timer.phase('wait'):
+                    wait_for_mission_end(self.agent_host)
 
             print("current_reward:", current_reward)
             self.reward += current_reward
 
             status = [prev_canvas, action, current_reward, canvas, game_over]
             print("status_reward:", status[2])
-            self.agent.memorize(status)
-            self.agent.train()
+            with timer.phase('learn'):
+                if self.learner is None:
+                    self.agent.memorize(status)
+                    loss = self.agent.train()
+                    print("loss:", loss, "mean Q:", self.agent.metrics['mean_q'],
+                          "target syncs:", self.agent.metrics['target_syncs'])
+                    if numpy_inference:
+                        policy.refresh()
+                else:
+                    self.learner.push(status)
+                    self.learner.refresh()
 
             if game_over:
                 print("game over")
+                if self.learner is not None:
+                    # Losses of the learner thread, reported from this one
+                    losses = self.learner.take_losses()
+                    print("Updates per step:", self.learner.ratio(),
+                          "loss:", losses[-1] if losses else None,
+                          "mean Q:", self.agent.metrics['mean_q'])
                 return 0
 
 
+def acting_copy(model):
+    """Copy of model for acting only: a NumpyNet with numpy_inference, else a Keras clone."""
+    if numpy_inference:
+        return NumpyNet(model.get_weights())
+    from keras.models import clone_model
+    return clone_model(model)
+
+
+def save_weights(agent, learner, filename):
+    """Save agent's weights to filename, from the learner's acting copy while its thread is fitting.
+
+    The copy is a Keras clone or, with numpy_inference, a NumpyNet; both
+    write the same .h5 layout.
+    """
+    saved = agent.model if learner is None else learner.acting_model
+    saved.save_weights(filename, overwrite=True)
+
+
 if __name__ == '__main__':
-    mission_xml = GetMissionXML()
     agent_host = MalmoPython.AgentHost()
     agent_host.setDebugOutput(False)
     load_weight_filename = "weights"
     save_weight_filename = "weights"
 
     model = build_model(load_weight_filename)
-    # Save model
-    with open(save_weight_filename + '.json', 'w') as outfile:
-        json.dump(model.to_json(), outfile)
-    ikun = iKun(model)
+    # Save model, unless weights.json already holds it
+    save_model_json(model, save_weight_filename + '.json')
+    ikun = iKun(model, target_sync=100, double_dqn=True)
     maze = Maze(agent_host, ikun)
 
     num_reps = 100000
     num_reps_to_save_weights = 50
+    if async_learning:
+        maze.learner = BackgroundLearner(ikun, lambda updates: ikun.train(), acting_copy(model)).start()
     for iRepeat in range(num_reps):
-        mission = MalmoPython.MissionSpec(mission_xml, True)
+        mission = mission_spec(**MISSION)
         mission_record = MalmoPython.MissionRecordSpec()
         my_client_pool = MalmoPython.ClientPool()
         my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
@@ -278,9 +321,10 @@ if __name__ == '__main__':
         print("maze run")
         maze.run()
 
-        # Save weights
         if num_reps % num_reps_to_save_weights == 0:
-            ikun.model.save_weights(save_weight_filename + '.h5', overwrite=True)
+            with maze.timer.phase('checkpoint'):
+                save_weights(ikun, maze.learner, save_weight_filename + '.h5')
             print("Weights saved.")
+        maze.timer.end_episode(iRepeat)
 
     time.sleep(10000)
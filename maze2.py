@@ -7,13 +7,26 @@ import json
 import random
 import numpy as np
 import math
-from keras.models import Sequential
-from keras.layers.core import Dense, Activation
-from keras.optimizers import SGD, Adam, RMSprop
-from keras.layers.advanced_activations import PReLU
-from PIL import Image
-import matplotlib.pyplot as plt
-import MalmoPython
+import functools
+from startup import LazyModule, save_model_json
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+import episode_reset
+from grid_decoder import decode_grid
+from maze_env import BatchMazeEnv
+from replay import ReplayMemory, PrioritizedReplayMemory
+from maze_solver import solved_canvases
+from actor_learner import ActorPool, ClientMazeEnv
+from async_learner import BackgroundLearner
+from inference_server import InferenceServer
+from numpy_net import NumpyNet, NumpyPolicy
+from mission_spec import mission_spec
+from frame_writer import FrameWriter
+from maze_view import MazeView
+from phase_timer import PhaseTimer
+from trajectory import TrajectoryWriter, Trajectories, shuffled_batches
+
+# Keras is imported by build_model and the clone_model callers
+MalmoPython = LazyModule('MalmoPython')
 
 ACTIONS = ['movenorth 1', 'movesouth 1', 'movewest 1', 'moveeast 1']
 MOVES = {0: [1, -1], 1: [1, 1], 2: [0, -1], 3: [0, 1]}
@@ -31,71 +44,49 @@ SELF = 4
 INIT_POS = [-1, -1]
 
 save_images = True
-
-
-def GetMissionXML(i):
-    return '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-            <Mission xmlns="http://ProjectMalmo.microsoft.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-              <About>
-                <Summary> Running Maze ''' + str(i) + ''' </Summary>
-              </About>
-            <ServerSection>
-              <ServerInitialConditions>
-                <Time>
-                    <StartTime>1000</StartTime>
-                    <AllowPassageOfTime>false</AllowPassageOfTime>
-                </Time>
-                <Weather>clear</Weather>
-              </ServerInitialConditions>
-              <ServerHandlers>
-                  <FlatWorldGenerator generatorString="3;7,44*49,73,35:1,159:4,95:13,35:13,159:11,95:10,159:14,159:6,35:6,95:6;12;"/>
-                  <DrawingDecorator>
-                    <DrawSphere x="-27" y="70" z="0" radius="30" type="air"/>
-                  </DrawingDecorator>
-                  <MazeDecorator>
-                    <Seed>0</Seed>
-                    <SizeAndPosition width="''' + str(10) + '''" length="''' + str(10) + '''" height="10" xOrigin="0" yOrigin="69" zOrigin="0"/>
-                    <StartBlock type="emerald_block" fixedToEdge="true"/>
-                    <EndBlock type="redstone_block" fixedToEdge="true"/>
-                    <PathBlock type="diamond_block"/>
-                    <FloorBlock type="air"/>
-                    <GapBlock type="stone"/>
-                    <GapProbability>''' + str(0.2) + '''</GapProbability>
-                    <AllowDiagonalMovement>false</AllowDiagonalMovement>
-                  </MazeDecorator>
-                  <ServerQuitFromTimeUp timeLimitMs="10000"/>
-                  <ServerQuitWhenAnyAgentFinishes/>
-                </ServerHandlers>
-              </ServerSection>
-              <AgentSection mode="Survival">
-                <Name>CS175AwesomeMazeBot</Name>
-                <AgentStart>
-                    <Placement x="''' + str(0.5) + '''" y="56.0" z="''' + str(0.5) + '''" yaw="0"/>
-                </AgentStart>
-                <AgentHandlers>
-                    <DiscreteMovementCommands/>
-                    <AbsoluteMovementCommands/>
-                    <RewardForSendingCommand reward="-1"/>
-                    <RewardForTouchingBlockType>
-                      <Block reward="100" type="redstone_block" behaviour="onceOnly"/>
-                    </RewardForTouchingBlockType>
-                    <AgentQuitFromTouchingBlockType>
-                        <Block type="redstone_block"/>
-                        <Block type="stone"/>
-                    </AgentQuitFromTouchingBlockType>
-                    <ObservationFromGrid>
-                      <Grid name="floorAll">
-                        <min x="-10" y="-1" z="-10"/>
-                        <max x="10" y="-1" z="10"/>
-                      </Grid>
-                  </ObservationFromGrid>
-                </AgentHandlers>
-              </AgentSection>
-            </Mission>'''
+# Frames wait for the background writers in a queue this long; extra ones are dropped
+frame_queue = 8
+# Draw the maze every step; off, matplotlib is never imported
+show_maze = True
+# With a directory, draw the maze offscreen into PNGs there, at most one per maze_frame_interval seconds
+maze_frames = None
+maze_frame_interval = 1.0
+# Time each phase of Maze.run and append per-episode percentiles to this file
+phase_metrics = None
+# Record every step to this trajectory.TrajectoryWriter directory
+record_trajectories = None
+# Instead of playing, train for offline_epochs on the steps recorded in this directory
+offline_trajectories = None
+offline_epochs = 10
+# Train on this many headless maze_env mazes in lockstep instead of the client
+batch_mazes = 0
+# Keep one mission alive and start each episode by teleporting. Such a mission
+# has no time-up, so Maze.run ends an episode after episode_time_limit seconds
+reset_by_teleport = False
+episode_time_limit = 10.0
+maze_seed = 0
+# full_stats lets episode_reset.teleport see where the agent landed
+MISSION = dict(size=10, gap_probability=0.2, origin=(0, 69, 0), full_stats=True)
+# Fit the model to solved Q-values of each new maze layout before training on it
+warm_start = False
+# Train from this many actor processes, each on its own client (actor_clients)
+# on ports 10000, 10001, ... or on headless mazes
+actors = 0
+actor_clients = False
+# Train in a background thread while Maze.run keeps acting
+async_learning = False
+# Actors predict through one batched inference_server.InferenceServer
+shared_inference = False
+# Act with a numpy_net.NumpyNet copy of the network instead of Keras: in Maze.run
+# (reloaded after each train), the learner thread's acting copy and the actors
+numpy_inference = False
 
 
 def build_model(load_weight_filename, lr=0.01):
     global ACTIONS
+    from keras.models import Sequential
+    from keras.layers.core import Dense
+    from keras.layers.advanced_activations import PReLU
     model = Sequential()
     model.add(Dense(MAP_LENGTH * MAP_WIDTH,
                     input_shape=(MAP_LENGTH * MAP_WIDTH, )))
@@ -110,48 +101,135 @@ def build_model(load_weight_filename, lr=0.01):
 
 class iKun(object):
 
-    def __init__(self, model, memory_length=20, gamma=0.8, epsilon=0):
+    def __init__(self, model, memory_length=50000, gamma=0.8, epsilon=0, memory_file=None,
+                 prioritized=False, target_sync=0, tau=None, double_dqn=False):
         self.model = model
-        self.memory = []
+        # Bootstrap from a separate target network, copied from the online
+        # model every target_sync training steps or Polyak-averaged with tau
+        self.target_model = None
+        if double_dqn and not (target_sync or tau):
+            raise ValueError("double_dqn needs a target network: set target_sync or tau")
+        if target_sync or tau:
+            from keras.models import clone_model
+            self.target_model = clone_model(model)
+            self.target_model.set_weights(model.get_weights())
+        self.target_sync = target_sync
+        self.tau = tau
+        self.double_dqn = double_dqn
+        self.metrics = {'train_steps': 0, 'target_syncs': 0, 'mean_q': 0.0, 'loss': 0.0}
+        if prioritized:
+            self.memory = PrioritizedReplayMemory(memory_length, MAP_LENGTH * MAP_WIDTH, memory_file)
+        else:
+            self.memory = ReplayMemory(memory_length, MAP_LENGTH * MAP_WIDTH, memory_file)
         self.memory_length = memory_length
         self.gamma = gamma
         self.epsilon = epsilon
 
     def memorize(self, status):
-        self.memory.append(status)
-        if len(self.memory) > self.memory_length:
-            del self.memory[0]
+        self.memory.append(*status)
 
     def predict(self, canvas):
         return self.model.predict(canvas)[0]
 
-    def train(self, repeat_time, loss_value, batch_size=5):
-        global ACTIONS
-
-        env_size = MAP_LENGTH * MAP_WIDTH
-        mem_size = len(self.memory)
-        data_size = min(mem_size, batch_size)
-
-        inputs = np.zeros((data_size, env_size))
-        targets = np.zeros((data_size, len(ACTIONS)))
-
-        for i, j in enumerate(np.random.choice(range(mem_size), data_size, replace=False)):
-            canvas, action, reward, canvas_next, game_over = self.memory[j]
-            inputs[i] = canvas
-            targets[i] = self.predict(canvas)
-            Q_sa = np.max(self.predict(canvas_next))
-            if game_over:
-                targets[i][action] = reward
+    def act_batch(self, canvases, valid):
+        """Pick one action per row of canvases with a single predict call."""
+        actions = self.model.predict(canvases)
+        actions[~valid] = -1e6
+        chosen = np.argmax(actions, axis=1)
+        explore = np.random.random(len(chosen)) < self.epsilon
+        if explore.any():
+            noise = np.random.random(actions.shape) * valid
+            chosen[explore] = np.argmax(noise[explore], axis=1)
+        return chosen
+
+    def targets(self, inputs, actions, rewards, canvas_next, game_over, batch_size=32):
+        """Q-learning targets for a batch of transitions, and their TD errors."""
+        data_size = len(actions)
+
+        # One forward pass for the current and next canvases of the whole batch
+        q = self.model.predict(np.concatenate([inputs, canvas_next]), batch_size=batch_size)
+        targets = q[:data_size]
+        if self.target_model is None:
+            Q_sa = np.max(q[data_size:], axis=1)
+        else:
+            q_target = self.target_model.predict(canvas_next, batch_size=batch_size)
+            if self.double_dqn:
+                # The online model picks the next action, the target model values it
+                Q_sa = q_target[np.arange(data_size), np.argmax(q[data_size:], axis=1)]
             else:
-                targets[i][action] = reward + self.gamma * Q_sa
+                Q_sa = np.max(q_target, axis=1)
+        self.metrics['mean_q'] = float(np.mean(np.max(targets, axis=1)))
+        expected = np.where(game_over, rewards, rewards + self.gamma * Q_sa)
+        errors = expected - targets[np.arange(data_size), actions]
+        targets[np.arange(data_size), actions] = expected
+        return targets, errors
+
+    def fit_batch(self, batch_size=5):
+        """One gradient step on a minibatch from memory; returns the loss."""
+        rows, weights = self.memory.sample_rows(batch_size)
+        inputs, actions, rewards, canvas_next, game_over = self.memory.get(rows)
+        targets, errors = self.targets(inputs, actions, rewards, canvas_next, game_over)
+        self.memory.update_priorities(rows, errors)
+
+        history = self.model.fit(inputs, targets, sample_weight=weights,
+                                 epochs=1, batch_size=5, verbose=0)
+        self.metrics['loss'] = history.history['loss'][-1]
+        self.metrics['train_steps'] += 1
+        self.sync_target()
+        return self.metrics['loss']
 
-        self.model.fit(inputs, targets, epochs=1, batch_size=5, verbose=0)
-        loss_value.append(self.model.evaluate(inputs, targets))
-        print("loss:", loss_value[-1])
+    def train(self, repeat_time, loss_value, batch_size=5):
+        loss_value.append(self.fit_batch(batch_size))
+        print("loss:", loss_value[-1], "mean Q:", self.metrics['mean_q'],
+              "target syncs:", self.metrics['target_syncs'])
 
+    def decay_epsilon(self, repeat_time):
+        """Called once per environment step, never from a learner thread."""
         if repeat_time > 0 and repeat_time % 20 == 0:
             self.epsilon *= 0.9
 
+    def train_offline(self, trajectories, epochs=1, batch_size=4096, fit_batch_size=256, seed=0):
+        """Train on recorded steps (a trajectory.Trajectories) for whole epochs.
+
+        Each batch of batch_size shuffled steps gets its targets from one
+        predict call and is then fitted in minibatches of fit_batch_size.
+        Returns the last loss of each epoch.
+        """
+        losses = []
+        for epoch in range(epochs):
+            for inputs, actions, rewards, canvas_next, game_over in \
+                    shuffled_batches(trajectories, batch_size, seed + epoch):
+                targets, _ = self.targets(inputs, actions, rewards, canvas_next, game_over,
+                                          batch_size=fit_batch_size)
+                history = self.model.fit(inputs, targets, epochs=1, batch_size=fit_batch_size, verbose=0)
+                self.metrics['loss'] = history.history['loss'][-1]
+                self.metrics['train_steps'] += 1
+                self.sync_target()
+            losses.append(self.metrics['loss'])
+            print("epoch:", epoch, "loss:", losses[-1], "mean Q:", self.metrics['mean_q'])
+        return losses
+
+    def pretrain(self, mazes, epochs=100, batch_size=32):
+        """Fit the model to Q-values solved from decoded mazes (see maze_solver)."""
+        canvases, targets = solved_canvases(mazes, self.gamma)
+        history = self.model.fit(canvases, targets, epochs=epochs, batch_size=batch_size, verbose=0)
+        if self.target_model is not None:
+            self.target_model.set_weights(self.model.get_weights())
+        self.metrics['loss'] = history.history['loss'][-1]
+        return self.metrics['loss']
+
+    def sync_target(self):
+        if self.target_model is None:
+            return
+        if self.tau:
+            self.target_model.set_weights([
+                self.tau * online + (1 - self.tau) * target for online, target in
+                zip(self.model.get_weights(), self.target_model.get_weights())])
+            self.metrics['target_syncs'] += 1
+        elif self.metrics['train_steps'] % self.target_sync == 0:
+            self.target_model.set_weights(self.model.get_weights())
+            self.metrics['target_syncs'] += 1
+
 
 class Maze(object):
 
@@ -162,8 +240,19 @@ class Maze(object):
         self.position = [-1, -1]
         self.boundary = [-1, -1, -1, -1]
         self.agent = agent
+        self.start = [-1, -1]
+        # Episodes are reset by teleport inside one episode_reset.PersistentMission
+        self.persistent = False
         self.reward = 0
         self.rep = 0  # for video recording
+        self.frames = FrameWriter(max_pending=frame_queue) if save_images else None
+        self.view = None
+        self.timer = PhaseTimer(phase_metrics)
+        self.recorder = TrajectoryWriter(record_trajectories) if record_trajectories is not None else None
+        self.solved = None
+        # async_learner.BackgroundLearner that trains the agent, if any
+        self.learner = None
+        self.episode = 0
 
     def initialize(self):
         global MAP_LENGTH, MAP_WIDTH, TARGET, AIR, LAND, INIT_POS
@@ -182,27 +271,18 @@ class Maze(object):
                 break
 
         if not grid == -1:
-            for i in range(len(grid)):
-                if grid[i] == "redstone_block":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = TARGET
-                elif grid[i] == "stone":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = AIR
-                elif grid[i] == "diamond_block":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
-                elif grid[i] == "emerald_block":
-                    INIT_POS = [i % MAP_WIDTH, i // MAP_WIDTH]
-                    self.position = INIT_POS
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
-                    print("self.position:", self.position)
+            maze, INIT_POS, target, self.boundary = decode_grid(grid)
+            self.maze[:] = maze
+            self.position = INIT_POS
+            if warm_start and not np.array_equal(maze, self.solved):
+                if self.learner is None:
+                    print("Pretrain loss:", self.agent.pretrain([maze]))
                 else:
-                    continue
-                # Track first block
-                if self.boundary[0] == -1:
-                    self.boundary[0] = i % MAP_WIDTH
-                    self.boundary[1] = i // MAP_WIDTH
-                # Track last block
-                self.boundary[2] = i % MAP_WIDTH
-                self.boundary[3] = i // MAP_WIDTH
+                    # The learner thread fits agent.model, so the pretrain runs there too
+                    print("Pretrain loss:", self.learner.call(lambda: self.agent.pretrain([maze])))
+                    self.learner.refresh()
+                self.solved = maze
+            print("self.position:", self.position)
             print(self.boundary)
 
     def get_canvas(self):
@@ -213,44 +293,30 @@ class Maze(object):
 
     def teleport(self, teleport_x, teleport_z):
         """Directly teleport to a specific position."""
-
-        # TODO: chenge the teleport position to random position
-        tp_command = "tp "+str(teleport_x+0.5)+" 71 "+str(teleport_z+0.5)
-        self.agent_host.sendCommand(tp_command)
-        # good_frame = False
-        # while not good_frame:
-        #     world_state = self.agent_host.getWorldState()
-        #     if not world_state.is_mission_running:
-        #         print("Mission ended prematurely - error.")
-        #         exit(1)
-        #     if not good_frame and world_state.number_of_video_frames_since_last_state > 0:
-        #         frame_x = world_state.video_frames[-1].xPos
-        #         frame_z = world_state.video_frames[-1].zPos
-        #         if math.fabs(frame_x - teleport_x) < 0.001 and math.fabs(frame_z - teleport_z) < 0.001:
-        #             good_frame = True
+        episode_reset.teleport(self.agent_host, teleport_x, teleport_z)
 
     def show(self):
-        plt.grid(True)
-        nrows, ncols = self.maze.shape
-        ax = plt.gca()
-        ax.set_xticks(np.arange(0.5, nrows, 1))
-        ax.set_yticks(np.arange(0.5, ncols, 1))
-        ax.set_xticklabels([])
-        ax.set_yticklabels([])
-        canvas = np.copy(self.maze)
-        canvas[self.position[0]][self.position[1]] = SELF
-        plt.imshow(canvas.transpose(), interpolation='none', cmap='gray')
-        plt.draw()
-        plt.gca().invert_xaxis()
-        plt.gca().invert_yaxis()
-        plt.pause(0.01)
+        if self.view is None:
+            self.view = MazeView(maze_frames, maze_frame_interval)
+        self.view.draw(self.maze, self.position)
 
-    def run(self, iRepeat, loss_value):
+    def run(self, iRepeat, loss_value, fresh=True):
         global ACTIONS, LAND
-        plt.ion()
-        plt.show()
-        self.initialize()
-        canvas = self.get_canvas()
+        self.episode = iRepeat
+        if self.learner is not None:
+            policy = self.learner
+        elif numpy_inference:
+            policy = NumpyPolicy(self.agent)
+        else:
+            policy = self.agent
+        timer = self.timer
+        with timer.phase('decode'):
+            if fresh:
+                self.initialize()
+                self.start = list(self.position)
+            else:
+                self.position = list(self.start)
+            canvas = self.get_canvas()
 
         if not iRepeat == 0:
             # self.boundary[0] <= INIT_POS[0] <= self.boundary[2]
@@ -281,53 +347,78 @@ class Maze(object):
             old_pos = self.position
             self.position = [startX + self.boundary[0],
                              startZ + self.boundary[1]]
-            time.sleep(0.2)
 
+        if self.recorder is not None:
+            self.recorder.begin_episode(self.maze)
+        deadline = time.time() + episode_time_limit
         while True:
             prev_canvas = canvas
+            prev_position = list(self.position)
             reward = 0
             rnd = random.random()
 
-            if rnd < self.agent.epsilon:
-                action = random.randint(0, 3)
-                while action == 0 and self.position[1] == self.boundary[1] or\
-                        action == 1 and self.position[1] == self.boundary[3] or \
-                        action == 2 and self.position[0] == self.boundary[0] or\
-                        action == 3 and self.position[0] == self.boundary[2]:
+            with timer.phase('act'):
+                if rnd < self.agent.epsilon:
                     action = random.randint(0, 3)
-            else:
-                actions = self.agent.predict(canvas)
-                action = np.argmax(actions)
-
-                while action == 0 and self.position[1] == self.boundary[1] or\
-                        action == 1 and self.position[1] == self.boundary[3] or \
-                        action == 2 and self.position[0] == self.boundary[0] or\
-                        action == 3 and self.position[0] == self.boundary[2]:
-                    actions[action] = -1e6
+                    while action == 0 and self.position[1] == self.boundary[1] or\
+                            action == 1 and self.position[1] == self.boundary[3] or \
+                            action == 2 and self.position[0] == self.boundary[0] or\
+                            action == 3 and self.position[0] == self.boundary[2]:
+                        action = random.randint(0, 3)
+                else:
+                    actions = policy.predict(canvas)
                     action = np.argmax(actions)
 
+                    while action == 0 and self.position[1] == self.boundary[1] or\
+                            action == 1 and self.position[1] == self.boundary[3] or \
+                            action == 2 and self.position[0] == self.boundary[0] or\
+                            action == 3 and self.position[0] == self.boundary[2]:
+                        actions[action] = -1e6
+                        action = np.argmax(actions)
+
             print("action:", action)
             self.position[MOVES[action][0]] += MOVES[action][1]
             print("position:", self.position)
-            agent_host.sendCommand(ACTIONS[action])
-            self.show()
-            time.sleep(0.3)
-            world_state = self.agent_host.getWorldState()
+            with timer.phase('send'):
+                agent_host.sendCommand(ACTIONS[action])
+            if show_maze:
+                with timer.phase('render'):
+                    self.show()
+            with timer.phase('wait'):
+                world_state = wait_for_world_state(self.agent_host, observation=self.persistent,
+                                                   video=save_images)
             for error in world_state.errors:
                 print("Error:", error.text)
             game_over = False if world_state.is_mission_running else True
 
             # Save images
             if save_images and len(world_state.video_frames) > 0:
-                frame = world_state.video_frames[-1]
-                image = Image.frombytes('RGB', (frame.width, frame.height), bytes(frame.pixels))
                 self.rep = self.rep + 1
-                image.save('rep_' + str(self.rep).zfill(3) + '.png')
+                with timer.phase('render'):
+                    self.frames.put(world_state.video_frames[-1], 'rep_' + str(self.rep).zfill(3) + '.png')
 
             # Update recognized maze
             current_reward = 0
             if len(world_state.rewards) > 0:
                 current_reward = world_state.rewards[-1].getValue()
+            if self.persistent:
+                outcome = episode_reset.episode_outcome(world_state)
+                game_over = game_over or outcome is not None
+                if outcome == episode_reset.GOAL:
+                    current_reward = 100
+                elif outcome is None and time.time() >= deadline:
+                    # Ends like the mission's time-up did: a terminal step at the fall reward
+                    print("time up")
+                    game_over = True
+            else:
+                # Goal or fall from the decoded maze, as maze_tabular's Tabular.act
+                # does: the mission only stops some ticks after the block is touched
+                cell = self.maze[self.position[0]][self.position[1]]
+                if cell == TARGET:
+                    current_reward = 100
+                    game_over = True
+                elif cell == AIR:
+                    game_over = True
 
             # if self.visited[self.position[0]][self.position[1]] == 0:
             #     current_reward += 2
@@ -337,72 +428,221 @@ class Maze(object):
                 current_reward = -50
 
             print("current_reward:", current_reward)
-            if current_reward > 1:
-                time.sleep(2)
+            if game_over and not self.persistent:
+                with timer.phase('wait'):
+                    wait_for_mission_end(self.agent_host)
+            if self.recorder is not None:
+                self.recorder.record(prev_position, action, current_reward, game_over)
             self.reward += current_reward
 
-            canvas = self.get_canvas()
-            status = [prev_canvas, action, self.reward, canvas, game_over]
-            self.agent.memorize(status)
-            self.agent.train(iRepeat, loss_value)
+            with timer.phase('decode'):
+                canvas = self.get_canvas()
+            # Per-step reward, as in run_batch, the actors and recorded trajectories;
+            # self.reward only keeps the running total
+            status = [prev_canvas, action, current_reward, canvas, game_over]
+            with timer.phase('learn'):
+                if self.learner is None:
+                    self.agent.memorize(status)
+                    self.agent.train(iRepeat, loss_value)
+                    if numpy_inference:
+                        policy.refresh()
+                else:
+                    self.learner.push(status)
+                    self.learner.refresh()
+            self.agent.decay_epsilon(iRepeat)
 
             if game_over:
                 print("game over")
+                if self.learner is not None:
+                    # Losses of the learner thread, reported from this one
+                    loss_value.extend(self.learner.take_losses())
+                    print("Updates per step:", self.learner.ratio(),
+                          "loss:", loss_value[-1] if loss_value else None,
+                          "mean Q:", self.agent.metrics['mean_q'])
                 return 0
 
 
-if __name__ == '__main__':
-    agent_host = MalmoPython.AgentHost()
-    agent_host.setDebugOutput(False)
-    load_weight_filename = "weights"
-    save_weight_filename = "weights"
+def run_batch(agent, env, num_steps, loss_value):
+    """Train agent on a maze_env.BatchMazeEnv, stepping all mazes at once."""
+    canvas = env.reset()
+    for step in range(num_steps):
+        actions = agent.act_batch(canvas, env.valid_actions())
+        canvas_next, rewards, dones = env.step(actions)
+        agent.memory.extend(canvas, actions, rewards, canvas_next, dones)
+        agent.train(step, loss_value)
+        agent.decay_epsilon(step)
+        canvas = env.canvases()
+
+
+def make_actor_env(index, clients=False, seed=0, batch=1):
+    """Environment of actor index: the client on port 10000 + index, or headless mazes."""
+    if clients:
+        return ClientMazeEnv(10000 + index, dict(MISSION, seed=seed))
+    return BatchMazeEnv(batch, seed=seed + index * batch, gap_probability=0.2)
+
+
+def make_actor_agent(index, load_weight_filename="weights", epsilon=0.1, model=None, use_numpy=False):
+    if model is None:
+        if use_numpy:
+            model = NumpyNet.from_h5(load_weight_filename + '.h5')
+        else:
+            model = build_model(load_weight_filename)
+    return iKun(model, memory_length=1, epsilon=epsilon)
 
+
+def acting_copy(model):
+    """Copy of model for acting only: a NumpyNet with numpy_inference, else a Keras clone."""
+    if numpy_inference:
+        return NumpyNet(model.get_weights())
+    from keras.models import clone_model
+    return clone_model(model)
+
+
+def save_weights(agent, learner, filename):
+    """Save agent's weights to filename, from the learner's acting copy while its thread is fitting.
+
+    The copy is a Keras clone or, with numpy_inference, a NumpyNet; both
+    write the same .h5 layout.
+    """
+    saved = agent.model if learner is None else learner.acting_model
+    saved.save_weights(filename, overwrite=True)
+
+
+def load_agent(load_weight_filename="weights", save_weight_filename="weights"):
+    """Build the model and the learning iKun on it.
+
+    build_model imports Keras, which takes seconds, so each entry path calls
+    this only after the setup it can do (and fail at) without Keras.
+    """
     model = build_model(load_weight_filename)
-    # Save model
-    with open(save_weight_filename + '.json', 'w') as outfile:
-        json.dump(model.to_json(), outfile)
-    ikun = iKun(model)
-    maze = Maze(agent_host, ikun)
+    # Save model, unless weights.json already holds it
+    save_model_json(model, save_weight_filename + '.json')
+    return iKun(model, target_sync=100, double_dqn=True)
+
+
+def run_distributed(agent, pool, num_steps, loss_value, broadcast_every=10):
+    """Train agent as the learner of an actor_learner.ActorPool.
+
+    Transitions from the actors are moved into agent.memory before every
+    training step and the weights are sent back every broadcast_every steps.
+    """
+    pool.start()
+    try:
+        pool.collect(agent.memory, block=True)
+        for step in range(num_steps):
+            pool.collect(agent.memory)
+            agent.train(step, loss_value)
+            agent.decay_epsilon(step)
+            if step % broadcast_every == 0:
+                pool.broadcast(agent.model.get_weights())
+    finally:
+        pool.stop()
+    print("Learner steps:", num_steps, "transitions:", pool.steps)
+
+
+def start_mission(agent_host, mission, iRepeat):
+    """Start mission (a MissionSpec, see mission_spec) on the local client."""
+    mission_record = MalmoPython.MissionRecordSpec()
+    my_client_pool = MalmoPython.ClientPool()
+    my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
+
+    max_retries = 3
+    for retry in range(max_retries):
+        try:
+            agent_host.startMission(
+                mission, my_client_pool, mission_record, 0, "iKun")
+            break
+        except RuntimeError as e:
+            if retry == max_retries - 1:
+                print("Error starting mission", (iRepeat + 1), ":", e)
+                exit(1)
+            else:
+                time.sleep(0.1)
+
+    world_state = agent_host.getWorldState()
+    while not world_state.has_mission_begun:
+        time.sleep(0.1)
+        world_state = agent_host.getWorldState()
+        for error in world_state.errors:
+            print("Error:", error.text)
 
+
+if __name__ == '__main__':
+    load_weight_filename = "weights"
+    save_weight_filename = "weights"
     num_reps = 100000
     num_reps_to_save_weights = 50
     loss = []
-    for iRepeat in range(num_reps):
-        mission_xml = GetMissionXML(iRepeat)
-        mission = MalmoPython.MissionSpec(mission_xml, True)
-        mission_record = MalmoPython.MissionRecordSpec()
-        mission.requestVideo(1280, 960)
-        mission.setViewpoint(1)
-        my_client_pool = MalmoPython.ClientPool()
-        my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
-
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                agent_host.startMission(
-                    mission, my_client_pool, mission_record, 0, "iKun")
-                break
-            except RuntimeError as e:
-                if retry == max_retries - 1:
-                    print("Error starting mission", (iRepeat + 1), ":", e)
-                    exit(1)
-                else:
-                    time.sleep(0.1)
 
-        world_state = agent_host.getWorldState()
-        while not world_state.has_mission_begun:
-            time.sleep(0.1)
-            world_state = agent_host.getWorldState()
-            for error in world_state.errors:
-                print("Error:", error.text)
+    # Offline training needs neither Malmo nor a Maze
+    if offline_trajectories is not None:
+        trajectories = Trajectories(offline_trajectories)
+        print("Offline training on", len(trajectories), "steps")
+        ikun = load_agent(load_weight_filename, save_weight_filename)
+        ikun.train_offline(trajectories, offline_epochs)
+        ikun.model.save_weights(save_weight_filename + '.h5', overwrite=True)
+        print("Weights saved.")
+        sys.exit(0)
+
+    if actors:
+        ikun = load_agent(load_weight_filename, save_weight_filename)
+        server = None
+        if shared_inference:
+            server = InferenceServer(acting_copy(ikun.model), clients=actors).start()
+            server.set_weights(ikun.model.get_weights())
+        pool = ActorPool(functools.partial(make_actor_env, clients=actor_clients, seed=maze_seed,
+                                           batch=max(1, batch_mazes)),
+                         functools.partial(make_actor_agent, load_weight_filename=load_weight_filename,
+                                           use_numpy=numpy_inference),
+                         actors, server=server)
+        run_distributed(ikun, pool, num_reps, loss)
+        if server is not None:
+            print("Mean inference batch:", server.mean_batch())
+            server.stop()
+        ikun.model.save_weights(save_weight_filename + '.h5', overwrite=True)
+        print("Weights saved.")
+        sys.exit(0)
+
+    if batch_mazes:
+        env = BatchMazeEnv(batch_mazes, gap_probability=0.2)
+        ikun = load_agent(load_weight_filename, save_weight_filename)
+        if warm_start:
+            print("Pretrain loss:", ikun.pretrain(env.mazes))
+        run_batch(ikun, env, num_reps, loss)
+        ikun.model.save_weights(save_weight_filename + '.h5', overwrite=True)
+        print("Weights saved.")
+        sys.exit(0)
+
+    agent_host = MalmoPython.AgentHost()
+    agent_host.setDebugOutput(False)
+    maze_mission = episode_reset.PersistentMission(agent_host, lambda seed: start_mission(
+        agent_host, mission_spec(seed=seed, persistent=True, video=(1280, 960), viewpoint=1, **MISSION), 0))
+    ikun = load_agent(load_weight_filename, save_weight_filename)
+    maze = Maze(agent_host, ikun)
+    maze.persistent = reset_by_teleport
+    if async_learning:
+        maze.learner = BackgroundLearner(ikun, lambda updates: ikun.fit_batch(),
+                                         acting_copy(ikun.model)).start()
+    for iRepeat in range(num_reps):
+        fresh = True
+        if reset_by_teleport:
+            fresh = maze_mission.begin(maze_seed)
+        else:
+            start_mission(agent_host, mission_spec(seed=maze_seed, video=(1280, 960), viewpoint=1, **MISSION),
+                          iRepeat)
 
         print("maze run")
-        maze.run(iRepeat, loss)
+        maze.run(iRepeat, loss, fresh)
 
-        # Save weights
         if num_reps % num_reps_to_save_weights == 0:
-            ikun.model.save_weights(
-                save_weight_filename + '.h5', overwrite=True)
+            with maze.timer.phase('checkpoint'):
+                save_weights(ikun, maze.learner, save_weight_filename + '.h5')
             print("Weights saved.")
+        maze.timer.end_episode(iRepeat)
 
+    if maze.recorder is not None:
+        maze.recorder.close()
+    if maze.frames is not None:
+        maze.frames.close()
+        print("Frames written:", maze.frames.written, "dropped:", maze.frames.dropped)
     time.sleep(10000)
@@ -8,12 +8,15 @@ import random
 import numpy as np
 import math
 import copy
-from keras.models import Sequential
-from keras.layers import Dense, Activation, Flatten
-from keras.optimizers import SGD, Adam, RMSprop
-from keras.layers.advanced_activations import PReLU
-import matplotlib.pyplot as plt
-import MalmoPython
+from startup import LazyModule, save_model_json
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+import episode_reset
+from grid_decoder import decode_grid
+from mission_spec import mission_spec
+from trajectory import TrajectoryWriter
+
+# Keras is imported by build_model
+MalmoPython = LazyModule('MalmoPython')
 
 ACTIONS = ['movenorth 1', 'movesouth 1', 'movewest 1', 'moveeast 1']
 MOVES = {0: [1, -1], 1: [1, 1], 2: [0, -1], 3: [0, 1]}
@@ -30,71 +33,21 @@ SELF = 4
 
 INIT_POS = [-1, -1]
 
-
-def GetMissionXML(i):
-    return '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-            <Mission xmlns="http://ProjectMalmo.microsoft.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-              <About>
-                <Summary> Running Maze ''' + str(i) + ''' </Summary>
-              </About>
-            <ServerSection>
-              <ServerInitialConditions>
-                <Time>
-                    <StartTime>1000</StartTime>
-                    <AllowPassageOfTime>false</AllowPassageOfTime>
-                </Time>
-                <Weather>clear</Weather>
-              </ServerInitialConditions>
-              <ServerHandlers>
-                  <FlatWorldGenerator generatorString="3;7,44*49,73,35:1,159:4,95:13,35:13,159:11,95:10,159:14,159:6,35:6,95:6;12;"/>
-                  <DrawingDecorator>
-                    <DrawSphere x="-27" y="70" z="0" radius="30" type="air"/>
-                  </DrawingDecorator>
-                  <MazeDecorator>
-                    <Seed>0</Seed>
-                    <SizeAndPosition width="''' + str(10) + '''" length="''' + str(10) + '''" height="10" xOrigin="0" yOrigin="69" zOrigin="0"/>
-                    <StartBlock type="emerald_block" fixedToEdge="true"/>
-                    <EndBlock type="redstone_block" fixedToEdge="true"/>
-                    <PathBlock type="diamond_block"/>
-                    <FloorBlock type="air"/>
-                    <GapBlock type="stone"/>
-                    <GapProbability>''' + str(0.2) + '''</GapProbability>
-                    <AllowDiagonalMovement>false</AllowDiagonalMovement>
-                  </MazeDecorator>
-                  <ServerQuitFromTimeUp timeLimitMs="10000"/>
-                  <ServerQuitWhenAnyAgentFinishes/>
-                </ServerHandlers>
-              </ServerSection>
-              <AgentSection mode="Survival">
-                <Name>CS175AwesomeMazeBot</Name>
-                <AgentStart>
-                    <Placement x="''' + str(0.5) + '''" y="56.0" z="''' + str(0.5) + '''" yaw="0"/>
-                </AgentStart>
-                <AgentHandlers>
-                    <DiscreteMovementCommands/>
-                    <AbsoluteMovementCommands/>
-                    <RewardForSendingCommand reward="-1"/>
-                    <RewardForTouchingBlockType>
-                      <Block reward="100" type="redstone_block" behaviour="onceOnly"/>
-                      <Block reward="-50" type="stone" behaviour="onceOnly"/>
-                    </RewardForTouchingBlockType>
-                    <AgentQuitFromTouchingBlockType>
-                        <Block type="redstone_block"/>
-                        <Block type="stone"/>
-                    </AgentQuitFromTouchingBlockType>
-                    <ObservationFromGrid>
-                      <Grid name="floorAll">
-                        <min x="-10" y="-1" z="-10"/>
-                        <max x="10" y="-1" z="10"/>
-                      </Grid>
-                  </ObservationFromGrid>
-                </AgentHandlers>
-              </AgentSection>
-            </Mission>'''
+# Keep one mission alive and start each episode by teleporting. Such a mission
+# has no time-up, so Maze.run ends an episode after episode_time_limit seconds
+reset_by_teleport = False
+episode_time_limit = 10.0
+maze_seed = 0
+# Record every step to this trajectory.TrajectoryWriter directory
+record_trajectories = None
+# full_stats lets episode_reset.teleport see where the agent landed
+MISSION = dict(size=10, gap_probability=0.2, origin=(0, 69, 0), full_stats=True, gap_reward=-50)
 
 
 def build_model(load_weight_filename, lr=0.001):
     global ACTIONS
+    from keras.models import Sequential
+    from keras.layers import Dense, Flatten
     model = Sequential()
     model.add(Dense(128, input_shape=(2, 2), activation='relu'))
     model.add(Flatten())
@@ -167,7 +120,12 @@ class Maze(object):
         self.visited = np.zeros((MAP_LENGTH, MAP_WIDTH))
         self.size = MAP_LENGTH*MAP_WIDTH
         self.agent = agent
+        self.start = [-1, -1]
+        # Episodes are reset by teleport inside one episode_reset.PersistentMission
+        self.persistent = False
         self.target = [-1, -1]
+        self.layout = None
+        self.recorder = TrajectoryWriter(record_trajectories) if record_trajectories is not None else None
 
     def initialize(self):
         global MAP_LENGTH, MAP_WIDTH, TARGET, AIR, LAND, INIT_POS
@@ -187,20 +145,7 @@ class Maze(object):
                 break
 
         if not grid == -1:
-            for i in range(len(grid)):
-                if grid[i] == "emerald_block":
-                    self.position = [i % MAP_WIDTH, i // MAP_WIDTH]
-                if grid[i] == 'redstone_block':
-                    self.target = [i % MAP_WIDTH, i // MAP_LENGTH]
-                if grid[i] == "air":
-                    continue
-
-                if self.boundary[0] == -1:
-                    self.boundary[0] = i % MAP_WIDTH
-                    self.boundary[1] = i // MAP_WIDTH
-                # Track last block
-                self.boundary[2] = i % MAP_WIDTH
-                self.boundary[3] = i // MAP_WIDTH
+            self.layout, self.position, self.target, self.boundary = decode_grid(grid)
             x, z = self.position
             self.visited[x-self.boundary[0], z-self.boundary[1]] = 1
 
@@ -218,9 +163,7 @@ class Maze(object):
 
     def teleport(self, teleport_x, teleport_z):
         """Directly teleport to a specific position."""
-
-        tp_command = "tp "+str(teleport_x+0.5)+" 71 "+str(teleport_z+0.5)
-        self.agent_host.sendCommand(tp_command)
+        episode_reset.teleport(self.agent_host, teleport_x, teleport_z)
 
     def choose_actions(self, state, possible_moves):
         rnd = random.random()
@@ -243,9 +186,16 @@ class Maze(object):
                     best.append((temp, a))
             return random.choice(best)
 
-    def run(self, iRepeat, loss_value):
+    def run(self, iRepeat, loss_value, fresh=True):
         global ACTIONS, LAND
-        self.initialize()
+        if fresh:
+            self.initialize()
+            self.start = list(self.position)
+        else:
+            self.position = list(self.start)
+            self.visited = np.zeros((MAP_LENGTH, MAP_WIDTH))
+            x, z = self.position
+            self.visited[x-self.boundary[0], z-self.boundary[1]] = 1
 
         if not iRepeat == 0:
             '''
@@ -283,9 +233,13 @@ class Maze(object):
             old_pos = self.position
             self.position = [startX + self.boundary[0],
                              startZ + self.boundary[1]]
-            time.sleep(0.2)
+        if self.recorder is not None:
+            self.recorder.begin_episode(self.layout)
+        deadline = time.time() + episode_time_limit
         while True:
             prev_pos = self.position
+            # choose_actions may move prev_pos itself
+            prev_position = list(self.position)
             movables = self.get_possible_actions()
             next_state, action = self.choose_actions(self.position, movables)
 
@@ -293,8 +247,7 @@ class Maze(object):
             self.position = next_state
             print("position:", self.position)
             agent_host.sendCommand(ACTIONS[action])
-            time.sleep(0.3)
-            world_state = self.agent_host.getWorldState()
+            world_state = wait_for_world_state(self.agent_host, observation=self.persistent)
             for error in world_state.errors:
                 print("Error:", error.text)
             game_over = False if world_state.is_mission_running else True
@@ -305,13 +258,34 @@ class Maze(object):
             current_reward = 0
             if len(world_state.rewards) > 0:
                 current_reward = world_state.rewards[-1].getValue()
-
-            if current_reward > 1:
-                time.sleep(2)
+            if self.persistent:
+                outcome = episode_reset.episode_outcome(world_state)
+                game_over = game_over or outcome is not None
+                if outcome == episode_reset.GOAL:
+                    current_reward = 100
+                elif outcome == episode_reset.FALL:
+                    current_reward = -50
+                elif time.time() >= deadline:
+                    # Ends like the mission's time-up did: the step's reward plus the exploration bonus
+                    print("time up")
+                    game_over = True
+            else:
+                # Goal or fall from the decoded layout, as maze_tabular's Tabular.act
+                # does: the mission only stops some ticks after the block is touched
+                if self.layout[x][z] == TARGET:
+                    current_reward = 100
+                    game_over = True
+                elif self.layout[x][z] == AIR:
+                    current_reward = -50
+                    game_over = True
+                if game_over:
+                    wait_for_mission_end(self.agent_host)
             if game_over:
                 current_reward += 100 * np.sum(self.visited) / self.size
 
             print("current_reward:", current_reward)
+            if self.recorder is not None:
+                self.recorder.record(prev_position, action, current_reward, game_over)
             next_movable = self.get_possible_actions()
 
             status = [prev_pos, next_state, current_reward,
@@ -324,6 +298,33 @@ class Maze(object):
                 return 0
 
 
+def start_mission(agent_host, mission, iRepeat):
+    """Start mission (a MissionSpec, see mission_spec) on the local client."""
+    mission_record = MalmoPython.MissionRecordSpec()
+    my_client_pool = MalmoPython.ClientPool()
+    my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
+
+    max_retries = 3
+    for retry in range(max_retries):
+        try:
+            agent_host.startMission(
+                mission, my_client_pool, mission_record, 0, "iKun")
+            break
+        except RuntimeError as e:
+            if retry == max_retries - 1:
+                print("Error starting mission", (iRepeat + 1), ":", e)
+                exit(1)
+            else:
+                time.sleep(0.1)
+
+    world_state = agent_host.getWorldState()
+    while not world_state.has_mission_begun:
+        time.sleep(0.1)
+        world_state = agent_host.getWorldState()
+        for error in world_state.errors:
+            print("Error:", error.text)
+
+
 if __name__ == '__main__':
     agent_host = MalmoPython.AgentHost()
     agent_host.setDebugOutput(False)
@@ -331,44 +332,26 @@ if __name__ == '__main__':
     save_weight_filename = "weights"
 
     model = build_model(load_weight_filename)
-    # Save model
-    with open(save_weight_filename + '.json', 'w') as outfile:
-        json.dump(model.to_json(), outfile)
+    # Save model, unless weights.json already holds it
+    save_model_json(model, save_weight_filename + '.json')
     ikun = iKun(model)
     maze = Maze(agent_host, ikun)
 
     num_reps = 100000
     num_reps_to_save_weights = 50
     loss = []
+    maze.persistent = reset_by_teleport
+    maze_mission = episode_reset.PersistentMission(agent_host, lambda seed: start_mission(
+        agent_host, mission_spec(seed=seed, persistent=True, **MISSION), 0))
     for iRepeat in range(num_reps):
-        mission_xml = GetMissionXML(iRepeat)
-        mission = MalmoPython.MissionSpec(mission_xml, True)
-        mission_record = MalmoPython.MissionRecordSpec()
-        my_client_pool = MalmoPython.ClientPool()
-        my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
-
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                agent_host.startMission(
-                    mission, my_client_pool, mission_record, 0, "iKun")
-                break
-            except RuntimeError as e:
-                if retry == max_retries - 1:
-                    print("Error starting mission", (iRepeat + 1), ":", e)
-                    exit(1)
-                else:
-                    time.sleep(0.1)
-
-        world_state = agent_host.getWorldState()
-        while not world_state.has_mission_begun:
-            time.sleep(0.1)
-            world_state = agent_host.getWorldState()
-            for error in world_state.errors:
-                print("Error:", error.text)
+        fresh = True
+        if reset_by_teleport:
+            fresh = maze_mission.begin(maze_seed)
+        else:
+            start_mission(agent_host, mission_spec(seed=maze_seed, **MISSION), iRepeat)
 
         print("maze run")
-        maze.run(iRepeat, loss)
+        maze.run(iRepeat, loss, fresh)
 
         # Save weights
         if num_reps % num_reps_to_save_weights == 0:
@@ -376,4 +359,6 @@ if __name__ == '__main__':
                 save_weight_filename + '.h5', overwrite=True)
             print("Weights saved.")
 
+    if maze.recorder is not None:
+        maze.recorder.close()
     time.sleep(10000)
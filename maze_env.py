@@ -0,0 +1,331 @@
+from __future__ import print_function
+import json
+import time
+import numpy as np
+
+ACTIONS = ['movenorth 1', 'movesouth 1', 'movewest 1', 'moveeast 1']
+MOVES = {0: [1, -1], 1: [1, 1], 2: [0, -1], 3: [0, 1]}
+
+SIZE = 10
+MAP_LENGTH = 2 * SIZE + 1
+MAP_WIDTH = 2 * SIZE + 1
+
+UNKNOWN = 0
+AIR = 1
+LAND = 2
+TARGET = 3
+SELF = 4
+
+
+def generate_maze(width, length, gap_probability, rng):
+    """Build a MazeDecorator-style layout on a width x length cell grid.
+
+    The start cell sits on the z=0 edge and the end cell on the opposite edge
+    (fixedToEdge="true"). A randomised spanning tree carves a guaranteed
+    path between them; every other cell becomes a gap with probability
+    gap_probability. Returns (cells, start, end) where cells[x][z] is LAND,
+    AIR (gap) or TARGET.
+    """
+    start = (rng.randint(width), 0)
+    end = (rng.randint(width), length - 1)
+
+    parent = {start: None}
+    frontier = [start]
+    while frontier:
+        i = rng.randint(len(frontier))
+        x, z = frontier[i]
+        neighbours = [(x + dx, z + dz) for dx, dz in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                      if 0 <= x + dx < width and 0 <= z + dz < length
+                      and (x + dx, z + dz) not in parent]
+        if neighbours:
+            cell = neighbours[rng.randint(len(neighbours))]
+            parent[cell] = (x, z)
+            frontier.append(cell)
+        else:
+            frontier[i] = frontier[-1]
+            frontier.pop()
+
+    cells = np.where(rng.random_sample((width, length)) < gap_probability, AIR, LAND).astype(np.int8)
+    cell = end
+    while cell is not None:
+        cells[cell] = LAND
+        cell = parent[cell]
+    cells[end] = TARGET
+    return cells, start, end
+
+
+def check_size(size):
+    """Raise ValueError unless a size x size maze fits the floorAll window.
+
+    The start cell sits on the window's centre and on the maze's z=0 edge,
+    so the maze may extend SIZE cells beyond it.
+    """
+    if not 1 <= size <= SIZE + 1:
+        raise ValueError("maze size must be between 1 and %d to fit the %dx%d floorAll window, got %r"
+                         % (SIZE + 1, MAP_LENGTH, MAP_WIDTH, size))
+
+
+class MazeEnv(object):
+    """Headless, in-process replacement for the MazeDecorator mission.
+
+    Mirrors the settings of mission_spec.mission_xml (seed, size,
+    GapProbability, block types, edge-fixed start and end) and the reward
+    rules of Tabular.act: step_reward for every move, goal_reward for
+    reaching the end block and fall_reward for stepping onto a gap or off
+    the maze. Coordinates are in the 21x21 floorAll window centred on the start block, indexed [x, z] like the
+    agents' own maze arrays. The generated layouts follow the same rules as
+    Malmo's generator but are not block-for-block identical to it.
+    """
+
+    def __init__(self, size=SIZE, seed=0, gap_probability=0.5,
+                 gap_block='stone', path_block='diamond_block',
+                 start_block='emerald_block', end_block='redstone_block',
+                 step_reward=-2, goal_reward=100, fall_reward=-50,
+                 max_steps=None):
+        check_size(size)
+        self.size = size
+        self.seed = seed
+        self.gap_probability = gap_probability
+        self.blocks = {UNKNOWN: 'air', AIR: gap_block, LAND: path_block, TARGET: end_block}
+        self.start_block = start_block
+        self.step_reward = step_reward
+        self.goal_reward = goal_reward
+        self.fall_reward = fall_reward
+        self.max_steps = max_steps
+        self.rng = np.random.RandomState(seed)
+        self.maze = None
+        self.position = [-1, -1]
+        self.steps = 0
+        self.generate()
+
+    def generate(self):
+        cells, start, end = generate_maze(self.size, self.size, self.gap_probability, self.rng)
+        offset_x = SIZE - start[0]
+        offset_z = SIZE - start[1]
+
+        self.maze = np.zeros((MAP_LENGTH, MAP_WIDTH), dtype=np.int8)
+        self.maze[offset_x:offset_x + self.size, offset_z:offset_z + self.size] = cells
+        self.start = [start[0] + offset_x, start[1] + offset_z]
+        self.target = [end[0] + offset_x, end[1] + offset_z]
+        # Plain lists index much faster than numpy scalars in step()
+        self.cells = self.maze.tolist()
+
+        # floorAll is ordered x fastest, then z
+        names = [self.blocks[code] for code in self.maze.transpose().ravel()]
+        names[self.start[1] * MAP_WIDTH + self.start[0]] = self.start_block
+        self.grid = names
+
+    def reset(self):
+        """Start a new episode and return the floorAll observation."""
+        if self.seed is None:
+            self.generate()
+        self.position = list(self.start)
+        self.steps = 0
+        return list(self.grid)
+
+    def step(self, action):
+        """Apply one of ACTIONS and return (position, reward, done)."""
+        axis, delta = MOVES[action]
+        self.position[axis] += delta
+        self.steps += 1
+        x, z = self.position
+
+        if 0 <= x < MAP_LENGTH and 0 <= z < MAP_WIDTH:
+            code = self.cells[x][z]
+        else:
+            code = UNKNOWN
+        if code == TARGET:
+            return list(self.position), self.goal_reward, True
+        if code == LAND:
+            done = self.max_steps is not None and self.steps >= self.max_steps
+            return list(self.position), self.step_reward, done
+        return list(self.position), self.fall_reward, True
+
+
+# (dx, dz) for each of ACTIONS, matching MOVES
+DELTAS = np.array([[0, -1], [0, 1], [-1, 0], [1, 0]])
+
+
+class BatchMazeEnv(object):
+    """N headless mazes stepped in lockstep for the DQN agents.
+
+    Layouts are stacked in an (n, 21, 21) int8 array and positions in an
+    (n, 2) array so a whole batch of moves is applied with a few array
+    operations. Canvases use the same encoding as maze2.Maze.get_canvas (the
+    decoded maze with SELF at the agent's position), one row of 441 per maze.
+    A maze that finishes is put back on its start cell straight away; when
+    seed is None it also gets a fresh layout.
+    """
+
+    def __init__(self, n, size=SIZE, seed=0, gap_probability=0.2,
+                 step_reward=-1, goal_reward=100, fall_reward=-50,
+                 max_steps=None):
+        check_size(size)
+        self.n = n
+        self.seed = seed
+        self.step_reward = step_reward
+        self.goal_reward = goal_reward
+        self.fall_reward = fall_reward
+        self.max_steps = max_steps
+        self.envs = [MazeEnv(size, None if seed is None else seed + i, gap_probability)
+                     for i in range(n)]
+        self.index = np.arange(n)
+        self.mazes = np.zeros((n, MAP_LENGTH, MAP_WIDTH), dtype=np.int8)
+        self.starts = np.zeros((n, 2), dtype=np.int64)
+        self.boundary = np.zeros((n, 4), dtype=np.int64)
+        for i in range(n):
+            self.load(i)
+        self.positions = self.starts.copy()
+        self.steps = np.zeros(n, dtype=np.int64)
+
+    def load(self, i):
+        env = self.envs[i]
+        self.mazes[i] = env.maze
+        self.starts[i] = env.start
+        xs, zs = np.nonzero(env.maze)
+        self.boundary[i] = [xs.min(), zs.min(), xs.max(), zs.max()]
+
+    def reset(self):
+        if self.seed is None:
+            for i in range(self.n):
+                self.envs[i].generate()
+                self.load(i)
+        self.positions[:] = self.starts
+        self.steps[:] = 0
+        return self.canvases()
+
+    def canvases(self):
+        canvas = self.mazes.astype(np.float32)
+        x = np.clip(self.positions[:, 0], 0, MAP_LENGTH - 1)
+        z = np.clip(self.positions[:, 1], 0, MAP_WIDTH - 1)
+        canvas[self.index, x, z] = SELF
+        return canvas.reshape((self.n, -1))
+
+    def valid_actions(self):
+        """(n, 4) mask of the moves that stay inside each maze's boundary."""
+        x, z = self.positions[:, 0], self.positions[:, 1]
+        return np.stack([z > self.boundary[:, 1], z < self.boundary[:, 3],
+                         x > self.boundary[:, 0], x < self.boundary[:, 2]], axis=1)
+
+    def step(self, actions):
+        """Apply one action per maze.
+
+        Returns (next_canvases, rewards, dones) for the moves just made. Mazes
+        that are done have already been reset, so self.canvases() gives the
+        observations to act on next.
+        """
+        self.positions += DELTAS[actions]
+        self.steps += 1
+        x, z = self.positions[:, 0], self.positions[:, 1]
+        inside = (x >= 0) & (x < MAP_LENGTH) & (z >= 0) & (z < MAP_WIDTH)
+        codes = np.where(inside, self.mazes[self.index,
+                                            np.clip(x, 0, MAP_LENGTH - 1),
+                                            np.clip(z, 0, MAP_WIDTH - 1)], UNKNOWN)
+
+        rewards = np.where(codes == TARGET, self.goal_reward,
+                           np.where(codes == LAND, self.step_reward, self.fall_reward)).astype(np.float32)
+        dones = codes != LAND
+        if self.max_steps is not None:
+            dones |= self.steps >= self.max_steps
+        next_canvases = self.canvases()
+
+        if dones.any():
+            if self.seed is None:
+                for i in np.flatnonzero(dones):
+                    self.envs[i].generate()
+                    self.load(i)
+            self.positions[dones] = self.starts[dones]
+            self.steps[dones] = 0
+        return next_canvases, rewards, dones
+
+
+class SimulatedReward(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class SimulatedText(object):
+    def __init__(self, text):
+        self.text = text
+
+
+class SimulatedWorldState(object):
+    def __init__(self, running, observations, rewards):
+        self.has_mission_begun = True
+        self.is_mission_running = running
+        self.observations = observations
+        self.rewards = rewards
+        self.video_frames = []
+        self.errors = []
+        self.number_of_observations_since_last_state = len(observations)
+
+
+class SimulatedAgentHost(object):
+    """Local stand-in for MalmoPython.AgentHost that plays a MazeEnv.
+
+    Call start_mission() where a script would start a Malmo mission, then
+    hand the host to an agent. Like the client, every getWorldState() while
+    the mission runs holds a floorAll observation centred on the agent.
+    Rewards come once for each movement command, step_delay seconds after
+    it was sent, and the mission stops when the agent reaches the end block
+    or falls. Other commands are ignored. Used by bench.py to time the
+    agents' loops without Minecraft.
+    """
+
+    def __init__(self, env, step_delay=0.0):
+        self.env = env
+        self.step_delay = step_delay
+        self.running = False
+        self.rewards = []
+        self.ready_at = 0
+        self.grid = None
+        self.names = None
+        self.texts = {}
+
+    def setDebugOutput(self, debug):
+        pass
+
+    def start_mission(self):
+        self.env.reset()
+        if self.grid is not self.env.grid:
+            # The layout around the start block, padded with air
+            self.grid = self.env.grid
+            self.names = np.full((3 * MAP_WIDTH, 3 * MAP_LENGTH), 'air', dtype=object)
+            self.names[MAP_WIDTH:2 * MAP_WIDTH, MAP_LENGTH:2 * MAP_LENGTH] = \
+                np.array(self.grid, dtype=object).reshape((MAP_WIDTH, MAP_LENGTH))
+            self.texts = {}
+        self.running = True
+        self.rewards = []
+
+    def observation(self):
+        """floorAll around the agent, x fastest then z, as JSON."""
+        x, z = self.env.position
+        key = (x, z)
+        if key not in self.texts:
+            x0 = x - self.env.start[0] + MAP_LENGTH
+            z0 = z - self.env.start[1] + MAP_WIDTH
+            if 0 <= x0 <= 2 * MAP_LENGTH and 0 <= z0 <= 2 * MAP_WIDTH:
+                grid = self.names[z0:z0 + MAP_WIDTH, x0:x0 + MAP_LENGTH].ravel().tolist()
+            else:
+                grid = ['air'] * (MAP_LENGTH * MAP_WIDTH)
+            self.texts[key] = json.dumps({'floorAll': grid})
+        return SimulatedText(self.texts[key])
+
+    def sendCommand(self, command):
+        if not self.running or command not in ACTIONS:
+            return
+        position, reward, done = self.env.step(ACTIONS.index(command))
+        self.rewards.append(SimulatedReward(reward))
+        self.ready_at = time.time() + self.step_delay
+        if done:
+            self.running = False
+
+    def getWorldState(self):
+        if self.step_delay and time.time() < self.ready_at:
+            return SimulatedWorldState(True, [], [])
+        rewards, self.rewards = self.rewards, []
+        observations = [self.observation()] if self.running else []
+        return SimulatedWorldState(self.running, observations, rewards)
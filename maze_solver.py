@@ -0,0 +1,100 @@
+from __future__ import print_function
+import numpy as np
+from maze_env import UNKNOWN, LAND, TARGET, SELF, DELTAS
+
+
+def neighbours(array, fill):
+    """(x, z, action) array of the value each move in ACTIONS lands on.
+
+    Moves off the window land on fill.
+    """
+    padded = np.pad(array, 1, mode='constant', constant_values=fill)
+    length, width = array.shape
+    return np.stack([padded[1 + dx:1 + dx + length, 1 + dz:1 + dz + width] for dx, dz in DELTAS],
+                    axis=2)
+
+
+def possible_actions(maze, boundary):
+    """(x, z, action) mask of the moves Tabular.get_possible_actions allows on LAND."""
+    x = np.arange(maze.shape[0])[:, None]
+    z = np.arange(maze.shape[1])[None, :]
+    moves = np.stack(np.broadcast_arrays(z != boundary[1], z != boundary[3],
+                                         x != boundary[0], x != boundary[2]), axis=2)
+    return moves & (maze == LAND)[:, :, None]
+
+
+def distance_to_goal(maze):
+    """Fewest moves from each LAND cell to the end block, -1 where it can't be reached."""
+    land = maze == LAND
+    distance = np.where(maze == TARGET, 0, -1)
+    frontier = maze == TARGET
+    steps = 0
+    while frontier.any():
+        steps += 1
+        frontier = neighbours(frontier, False).any(axis=2) & land & (distance < 0)
+        distance[frontier] = steps
+    return distance
+
+
+def solve(maze, gamma, step_reward=-1, goal_reward=100, fall_reward=-50, boundary=None,
+          tolerance=1e-6, max_iterations=1000):
+    """Exact Q-values of a decoded maze by value iteration.
+
+    Moving onto LAND costs step_reward and continues, onto the end block
+    pays goal_reward and onto anything else (a gap, or off the known maze)
+    pays fall_reward; both of those end the episode. With boundary set only
+    the moves Tabular would consider count towards a cell's value.
+    Returns (q, valid): a float32 (x, z, action) array of Q-values and the
+    mask of the moves that were taken into account, both zero off LAND.
+    """
+    land = maze == LAND
+    codes = neighbours(maze, UNKNOWN)
+    rewards = np.where(codes == TARGET, goal_reward,
+                       np.where(codes == LAND, step_reward, fall_reward)).astype(np.float64)
+    continues = codes == LAND
+    if boundary is None:
+        valid = np.repeat(land[:, :, None], len(DELTAS), axis=2)
+    else:
+        valid = possible_actions(maze, boundary)
+    has_move = valid.any(axis=2)
+
+    values = np.zeros(maze.shape)
+    for _ in range(max_iterations):
+        q = rewards + gamma * neighbours(values, 0.0) * continues
+        best = np.where(has_move, np.where(valid, q, -np.inf).max(axis=2), 0.0)
+        done = np.abs(best - values).max() < tolerance
+        values = best
+        if done:
+            break
+    return np.where(valid, q, 0).astype(np.float32), valid
+
+
+def seed_q_table(q_table, q, valid):
+    """Copy solved Q-values into a qtable.QTable where it has none yet.
+
+    Entries the agent has already initialised keep their learned values.
+    Returns the number of entries written.
+    """
+    fill = valid & ~q_table.valid
+    q_table.values[fill] = q[fill]
+    q_table.valid |= fill
+    return int(np.count_nonzero(fill))
+
+
+def solved_canvases(mazes, gamma, step_reward=-1, goal_reward=100, fall_reward=-50):
+    """(canvases, targets) for every LAND cell of each maze, for fitting iKun.
+
+    Canvases follow maze2.Maze.get_canvas (the maze with SELF at the
+    agent's position, one row of 441) and targets hold the solved Q-value of
+    each of the four moves.
+    """
+    canvases, targets = [], []
+    for maze in mazes:
+        maze = np.asarray(maze)
+        q, _ = solve(maze, gamma, step_reward, goal_reward, fall_reward)
+        xs, zs = np.nonzero(maze == LAND)
+        canvas = np.repeat(maze.astype(np.float32)[None], len(xs), axis=0)
+        canvas[np.arange(len(xs)), xs, zs] = SELF
+        canvases.append(canvas.reshape((len(xs), -1)))
+        targets.append(q[xs, zs])
+    return np.concatenate(canvases), np.concatenate(targets)
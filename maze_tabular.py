@@ -7,14 +7,22 @@ import json
 import random
 import numpy as np
 import math
-from keras.models import Sequential
-from keras.layers.core import Dense, Activation
-from keras.optimizers import SGD, Adam, RMSprop
-from keras.layers.advanced_activations import PReLU
-from PIL import Image
 from collections import deque
-import matplotlib.pyplot as plt
-import MalmoPython
+from startup import LazyModule
+from maze_env import MazeEnv
+from malmo_sync import wait_for_world_state, wait_for_mission_end
+from episode_reset import PersistentMission, teleport
+from grid_decoder import decode_grid
+from qtable import QTable, QTableLog, snapshot_filename
+from n_step import DiscountedWindow
+from maze_solver import solve, seed_q_table
+from mission_spec import mission_spec
+from maze_view import MazeView
+from phase_timer import PhaseTimer
+from trajectory import TrajectoryWriter
+
+plt = LazyModule('matplotlib.pyplot')
+MalmoPython = LazyModule('MalmoPython')
 
 
 ACTIONS = ['movenorth 1', 'movesouth 1', 'movewest 1', 'moveeast 1']
@@ -30,85 +38,82 @@ LAND = 2
 TARGET = 3
 SELF = 4
 
-def GetMissionXML(i):
-    global SIZE
-    return '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-            <Mission xmlns="http://ProjectMalmo.microsoft.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
-              <About>
-                <Summary> Running Maze ''' + str(i) + ''' </Summary>
-              </About>
-            <ServerSection>
-              <ServerInitialConditions>
-                <Time>
-                    <StartTime>1000</StartTime>
-                    <AllowPassageOfTime>false</AllowPassageOfTime>
-                </Time>
-                <Weather>clear</Weather>
-              </ServerInitialConditions>
-              <ServerHandlers>
-                  <FlatWorldGenerator generatorString="3;7,44*49,73,35:1,159:4,95:13,35:13,159:11,95:10,159:14,159:6,35:6,95:6;12;"/>
-                  <DrawingDecorator>
-                    <DrawSphere x="-27" y="70" z="0" radius="30" type="air"/>
-                  </DrawingDecorator>
-                  <MazeDecorator>
-                    <Seed>0</Seed>
-                    <SizeAndPosition width="''' + str(SIZE) + '''" length="''' + str(SIZE) + '''" height="10" xOrigin="-32" yOrigin="69" zOrigin="-5"/>
-                    <StartBlock type="emerald_block" fixedToEdge="true"/>
-                    <EndBlock type="redstone_block" fixedToEdge="true"/>
-                    <PathBlock type="diamond_block"/>
-                    <FloorBlock type="air"/>
-                    <GapBlock type="stone"/>
-                    <GapProbability>''' + str(0.5) + '''</GapProbability>
-                    <AllowDiagonalMovement>false</AllowDiagonalMovement>
-                  </MazeDecorator>
-                  <ServerQuitFromTimeUp timeLimitMs="10000"/>
-                  <ServerQuitWhenAnyAgentFinishes/>
-                </ServerHandlers>
-              </ServerSection>
-              <AgentSection mode="Survival">
-                <Name>CS175AwesomeMazeBot</Name>
-                <AgentStart>
-                    <Placement x="''' + str(0.5) + '''" y="56.0" z="''' + str(0.5) + '''" yaw="0"/>
-                </AgentStart>
-                <AgentHandlers>
-                    <DiscreteMovementCommands/>
-                    <AbsoluteMovementCommands/>
-                    <RewardForSendingCommand reward="-1"/>
-                    <RewardForTouchingBlockType>
-                      <Block reward="100" type="redstone_block" behaviour="onceOnly"/>
-                    </RewardForTouchingBlockType>
-                    <AgentQuitFromTouchingBlockType>
-                        <Block type="redstone_block"/>
-                        <Block type="stone"/>
-                    </AgentQuitFromTouchingBlockType>
-                    <ObservationFromGrid>
-                      <Grid name="floorAll">
-                        <min x="-10" y="-1" z="-10"/>
-                        <max x="10" y="-1" z="10"/>
-                      </Grid>
-                  </ObservationFromGrid>
-                </AgentHandlers>
-              </AgentSection>
-            </Mission>'''
+# xOrigin and zOrigin of the MazeDecorator
+MAZE_ORIGIN = [-32, -5]
+
+# Train against the in-process maze_env.MazeEnv instead of a Minecraft client
+headless = False
+# Keep one mission alive and start each episode by teleporting to the start
+reset_by_teleport = False
+maze_seed = 0
+MISSION = dict(size=SIZE, gap_probability=0.5, origin=(MAZE_ORIGIN[0], 69, MAZE_ORIGIN[1]))
+# Also write the Q table to table.json (the old format) after training
+export_json = False
+# Seed states the table hasn't seen yet with Q-values solved from the decoded maze
+warm_start = False
+# Plot the training curves at the end; off, matplotlib is never imported
+plot_results = True
+# With a directory, draw the maze offscreen into PNGs there, at most one per maze_frame_interval seconds
+maze_frames = None
+maze_frame_interval = 1.0
+# Time each phase of an episode and append per-episode percentiles to this file
+phase_metrics = None
+# Record every step to this trajectory.TrajectoryWriter directory
+record_trajectories = None
+# Print each maze's boundary and each episode's reward; turn off for fast headless runs
+verbose = True
+
+
+def start_mission(agent_host, mission, iRepeat):
+    """Start mission (a MissionSpec, see mission_spec) on the local client."""
+    mission_record = MalmoPython.MissionRecordSpec()
+
+    my_client_pool = MalmoPython.ClientPool()
+    my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
+
+    max_retries = 3
+    for retry in range(max_retries):
+        try:
+            agent_host.startMission(
+                mission, my_client_pool, mission_record, 0, "Tabular")
+            break
+        except RuntimeError as e:
+            if retry == max_retries - 1:
+                print("Error starting mission", (iRepeat + 1), ":", e)
+                exit(1)
+            else:
+                time.sleep(0.1)
+
+    world_state = agent_host.getWorldState()
+    while not world_state.has_mission_begun:
+        time.sleep(0.1)
+        world_state = agent_host.getWorldState()
+        for error in world_state.errors:
+            print("Error:", error.text)
 
 
 class Tabular(object):
-    def __init__(self, epsilon=0, alpha=0.3, gamma=0.6, q_table={}):
+    def __init__(self, epsilon=0, alpha=0.3, gamma=0.6, q_table=None, log=None):
         self.epsilon = epsilon
         self.alpha = alpha
         self.gamma = gamma
         self.positive_n = 5
         self.negative_n = 1
-        self.q_table = q_table
+        self.q_table = QTable() if q_table is None else q_table
+        self.log = log
         self.position = [-1, -1]
+        self.start = [-1, -1]
         self.boundary = [-1, -1, -1, -1]
         self.maze = np.zeros((MAP_LENGTH, MAP_WIDTH))
+        self.env_grid = None
+        self.view = None
+        self.timer = PhaseTimer(phase_metrics)
+        self.recorder = TrajectoryWriter(record_trajectories) if record_trajectories is not None else None
         self.exploration_scores = []
         self.rewards = []
         self.nums_steps = []
 
     def initialize(self,  agent_host):
-        global MAP_LENGTH, MAP_WIDTH, TARGET, AIR, LAND, INIT_POS
         grid = -1
         world_state = agent_host.getWorldState()
         while world_state.has_mission_begun:
@@ -124,29 +129,20 @@ class Tabular(object):
                 break
 
         if not grid == -1:
-            for i in range(len(grid)):
-                if grid[i] == "redstone_block":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = TARGET
-                elif grid[i] == "stone":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = AIR
-                elif grid[i] == "diamond_block":
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
-                elif grid[i] == "emerald_block":
-                    INIT_POS = [i % MAP_WIDTH, i // MAP_WIDTH]
-                    self.position = INIT_POS
-                    self.maze[i % MAP_WIDTH][i // MAP_WIDTH] = LAND
-                else:
-                    continue
-                # Track first block
-                if self.boundary[0] == -1:
-                    self.boundary[0] = i % MAP_WIDTH
-                    self.boundary[1] = i // MAP_WIDTH
-                # Track last block
-                self.boundary[2] = i % MAP_WIDTH
-                self.boundary[3] = i // MAP_WIDTH
+            self.load_grid(grid)
+
+    def load_grid(self, grid):
+        global INIT_POS
+        with self.timer.phase('decode'):
+            maze, INIT_POS, target, self.boundary = decode_grid(grid)
+        self.maze = maze
+        self.position = INIT_POS
+        if warm_start:
+            seed_q_table(self.q_table, *solve(maze, self.gamma, -2, 100, -50, self.boundary))
+        if verbose:
             print(self.boundary)
 
-    def get_possible_actions(self, agent_host):
+    def get_possible_actions(self, agent_host=None):
         actions = [0, 1, 2, 3]
         if self.position[1] == self.boundary[1]:
             actions.remove(0)
@@ -159,48 +155,36 @@ class Tabular(object):
         return actions
 
     def show(self):
-        plt.grid(True)
-        nrows, ncols = self.maze.shape
-        ax = plt.gca()
-        ax.set_xticks(np.arange(0.5, nrows, 1))
-        ax.set_yticks(np.arange(0.5, ncols, 1))
-        ax.set_xticklabels([])
-        ax.set_yticklabels([])
-        canvas = np.copy(self.maze)
-        canvas[self.position[0]][self.position[1]] = SELF
-        plt.imshow(canvas.transpose(), interpolation='none', cmap='gray')
-        plt.draw()
-        plt.gca().invert_xaxis()
-        plt.gca().invert_yaxis()
-        plt.pause(0.01)
+        if self.view is None:
+            self.view = MazeView(maze_frames, maze_frame_interval)
+        self.view.draw(self.maze, self.position)
 
     def choose_action(self, curr_state, possible_actions):
-        if curr_state not in self.q_table:
-            self.q_table[curr_state] = {}
+        x, z = curr_state
+        valid = self.q_table.valid[x, z]
         for action in possible_actions:
-            if action not in self.q_table[curr_state]:
-                self.q_table[curr_state][action] = 0
+            valid[action] = True
 
         rnd = random.random()
         if rnd < self.epsilon:
             a_idx = random.randint(0, len(possible_actions) - 1)
             a = possible_actions[a_idx]
         else:
-            max_q = max(self.q_table[curr_state][act] for act in possible_actions)
-            max_a = []
-            for act in possible_actions:
-                if self.q_table[curr_state][act] == max_q:
-                    max_a.append(act)
+            q = self.q_table.values[x, z].tolist()
+            max_q = max(q[act] for act in possible_actions)
+            max_a = [act for act in possible_actions if q[act] == max_q]
             a = random.choice(max_a)
 
         return a
 
-    def act(self, agent_host, action):
+    def act(self, agent_host, action, persistent=False):
         global ACTIONS, MOVES, TARGET
-        agent_host.sendCommand(ACTIONS[action])
+        with self.timer.phase('send'):
+            agent_host.sendCommand(ACTIONS[action])
         self.position[MOVES[action][0]] += MOVES[action][1]
 
-        world_state = agent_host.getWorldState()
+        with self.timer.phase('wait'):
+            wait_for_world_state(agent_host)
         game_over = False
 
         reward = -2
@@ -211,36 +195,82 @@ class Tabular(object):
             reward = -50
             game_over = True
 
-        if game_over:
-            while world_state.is_mission_running:
-                world_state = agent_host.getWorldState()
+        if game_over and not persistent:
+            with self.timer.phase('wait'):
+                wait_for_mission_end(agent_host)
+
+        return [game_over, reward]
 
+    def act_env(self, env, action):
+        with self.timer.phase('wait'):
+            position, reward, game_over = env.step(action)
+        self.position = position
         return [game_over, reward]
 
     def update_q_table(self, tau, S, A, R, T):
+        # R is a DiscountedWindow, so G costs the same for any window length
         curr_s, curr_a, curr_r = S.popleft(), A.popleft(), R.popleft()
-        G = sum([self.gamma ** i * R[i] for i in range(len(S))])
+        G = R.total()
 
-        n = self.positive_n if R[-1] > 0 else self.negative_n
+        n = self.positive_n if R.last > 0 else self.negative_n
         if tau + n < T:
-            G += self.gamma ** n * self.q_table[S[-1]][A[-1]]
+            G += self.gamma ** n * self.q_table.values[S[-1] + (A[-1], )]
 
-        old_q = self.q_table[curr_s][curr_a]
-        self.q_table[curr_s][curr_a] = old_q + self.alpha * (G - old_q)
+        old_q = self.q_table.values[curr_s + (curr_a, )]
+        new_q = old_q + self.alpha * (G - old_q)
+        self.q_table.values[curr_s + (curr_a, )] = new_q
+        if self.log is not None:
+            self.log.record(curr_s[0], curr_s[1], curr_a, new_q)
 
 
     def run(self, agent_host):
         # plt.ion()
         # plt.show()
-        S, A, R = deque(), deque(), deque()
+        self.initialize(agent_host)
+        self.play(lambda action: self.act(agent_host, action))
+
+    def run_persistent(self, agent_host, mission, seed):
+        """Play one episode inside an episode_reset.PersistentMission.
+
+        The maze is decoded only when the mission is (re)started; otherwise
+        the agent is teleported back to the start block.
+        """
+        if mission.begin(seed):
+            self.initialize(agent_host)
+            self.start = list(self.position)
+        else:
+            teleport(agent_host, MAZE_ORIGIN[0] + self.start[0] - self.boundary[0],
+                     MAZE_ORIGIN[1] + self.start[1] - self.boundary[1])
+            self.position = list(self.start)
+        self.play(lambda action: self.act(agent_host, action, persistent=True))
+
+    def run_env(self, env):
+        """Play one episode against a headless maze_env.MazeEnv.
+
+        The grid is decoded again only when env generated a new maze.
+        """
+        grid = env.reset()
+        if env.grid is not self.env_grid:
+            self.load_grid(grid)
+            self.env_grid = env.grid
+            self.start = list(self.position)
+        else:
+            self.position = list(self.start)
+        self.play(lambda action: self.act_env(env, action))
+
+    def play(self, act):
+        S, A, R = deque(), deque(), DiscountedWindow(self.gamma)
         visited = np.zeros((MAP_LENGTH, MAP_WIDTH))
         done_update = False
-        self.initialize(agent_host)
+        timer = self.timer
+        if self.recorder is not None:
+            self.recorder.begin_episode(self.maze)
 
         while not done_update:
-            s0 = str(self.position)
-            possible_actions = self.get_possible_actions(agent_host)
-            a0 = self.choose_action(s0, possible_actions)
+            s0 = tuple(self.position)
+            with timer.phase('act'):
+                possible_actions = self.get_possible_actions()
+                a0 = self.choose_action(s0, possible_actions)
 
             S.append(s0)
             A.append(a0)
@@ -248,40 +278,45 @@ class Tabular(object):
 
             T = sys.maxsize
             for t in range(sys.maxsize):
-                time.sleep(0.1)
                 if t < T:
-                    game_over, current_reward = self.act(agent_host, A[-1])
+                    game_over, current_reward = act(A[-1])
                     if game_over:
                         exploration_score = np.sum(visited) / (SIZE * SIZE)
                         self.exploration_scores.append(exploration_score)
                         current_reward += exploration_score * 70
                         self.rewards.append(current_reward)
                         self.nums_steps.append(t + 1)
-                        print("Reward:", current_reward)
+                        if verbose:
+                            print("Reward:", current_reward)
                     else:
                         visited[self.position[0]][self.position[1]] = 1
                     # if iRepeat > 100:
                         # self.show()
                     R.append(current_reward)
+                    if self.recorder is not None:
+                        self.recorder.record(S[-1], A[-1], current_reward, game_over)
 
                     if game_over:
                         T = t + 1
-                        S.append('Term State')
+                        S.append(None)
                     else:
-                        s = str(self.position)
+                        s = tuple(self.position)
                         S.append(s)
-                        possible_actions = self.get_possible_actions(agent_host)
-                        next_a = self.choose_action(s, possible_actions)
+                        with timer.phase('act'):
+                            possible_actions = self.get_possible_actions()
+                            next_a = self.choose_action(s, possible_actions)
                         A.append(next_a)
 
                 tau = t - self.negative_n + 1
                 if tau >= 0:
-                    self.update_q_table(tau, S, A, R, T)
+                    with timer.phase('learn'):
+                        self.update_q_table(tau, S, A, R, T)
 
                 if tau == T - 1:
-                    while len(S) > 1:
-                        tau = tau + 1
-                        self.update_q_table(tau, S, A, R, T)
+                    with timer.phase('learn'):
+                        while len(S) > 1:
+                            tau = tau + 1
+                            self.update_q_table(tau, S, A, R, T)
                     done_update = True
                     break
 
@@ -289,73 +324,67 @@ class Tabular(object):
 if __name__ == '__main__':
     agent_host = MalmoPython.AgentHost()
     agent_host.setDebugOutput(False)
-    load_weight_filename = "table.json"
-    save_weight_filename = "table.json"
-
-    # Load Q Table
-    table = {}
-    try:
-        with open(load_weight_filename, 'r') as infile:
-            table = json.load(infile)
-            print("Q table loaded:", table)
-    except:
-        print("No Q table found. Use empty Q table.")
-    tabular = Tabular(q_table=table)
+    table_filename = "table"
+    json_filename = "table.json"
+
+    # Load Q Table, importing the JSON format once if there is no table yet.
+    # Updates since the last snapshot are replayed from table.log
+    has_table = os.path.exists(snapshot_filename(table_filename)) or os.path.exists(table_filename + '.npy')
+    if not has_table and os.path.exists(json_filename):
+        with open(json_filename, 'r') as infile:
+            QTable.from_json(json.load(infile)).save(table_filename)
+        print("Q table imported from", json_filename)
+    log = QTableLog.open(table_filename)
+    print("Q table loaded:", len(log.q_table), "states")
+    tabular = Tabular(q_table=log.q_table, log=log)
 
     num_reps = 150
     num_reps_to_save_weights = 50
+    env = MazeEnv(seed=0, gap_probability=0.5) if headless else None
+    maze_mission = PersistentMission(agent_host, lambda seed: start_mission(
+        agent_host, mission_spec(seed=seed, persistent=True, **MISSION), 0))
     for iRepeat in range(num_reps):
-        mission_xml = GetMissionXML(iRepeat)
-        mission = MalmoPython.MissionSpec(mission_xml, True)
-        mission_record = MalmoPython.MissionRecordSpec()
-
-        my_client_pool = MalmoPython.ClientPool()
-        my_client_pool.add(MalmoPython.ClientInfo("127.0.0.1", 10000))
-
-        max_retries = 3
-        for retry in range(max_retries):
-            try:
-                agent_host.startMission(
-                    mission, my_client_pool, mission_record, 0, "Tabular")
-                break
-            except RuntimeError as e:
-                if retry == max_retries - 1:
-                    print("Error starting mission", (iRepeat + 1), ":", e)
-                    exit(1)
-                else:
-                    time.sleep(0.1)
-
-        world_state = agent_host.getWorldState()
-        while not world_state.has_mission_begun:
-            time.sleep(0.1)
-            world_state = agent_host.getWorldState()
-            for error in world_state.errors:
-                print("Error:", error.text)
-
-        tabular.run(agent_host)
+        if headless:
+            tabular.run_env(env)
+        elif reset_by_teleport:
+            tabular.run_persistent(agent_host, maze_mission, maze_seed)
+        else:
+            start_mission(agent_host, mission_spec(seed=maze_seed, **MISSION), iRepeat)
+            tabular.run(agent_host)
 
         # Save weights
-        with open(save_weight_filename, 'w') as outfile:
-            json.dump(tabular.q_table, outfile)
-        print("Q Table saved.")
+        with tabular.timer.phase('checkpoint'):
+            log.flush()
+        if verbose:
+            print("Q Table saved.")
+        tabular.timer.end_episode(iRepeat)
 
         if iRepeat % num_reps_to_save_weights == 0:
             tabular.epsilon -= 0.05
             tabular.epsilon = max(0, tabular.epsilon)
 
-        time.sleep(0.1)
-
-    plt.plot(tabular.exploration_scores)
-    plt.xlabel("Number of Epochs")
-    plt.ylabel('Exploration Rate per Epoch')
-    plt.show()
-
-    plt.plot(tabular.rewards)
-    plt.xlabel("Number of Epochs")
-    plt.ylabel('Rewards per Epoch')
-    plt.show()
+        if not headless:
+            time.sleep(0.1)
 
-    plt.plot(tabular.nums_steps)
-    plt.xlabel("Number of Epochs")
-    plt.ylabel('Number of Steps Taken per Epoch')
-    plt.show()
+    log.close()
+    if tabular.recorder is not None:
+        tabular.recorder.close()
+    if export_json:
+        with open(json_filename, 'w') as outfile:
+            json.dump(tabular.q_table.to_json(), outfile)
+
+    if plot_results:
+        plt.plot(tabular.exploration_scores)
+        plt.xlabel("Number of Epochs")
+        plt.ylabel('Exploration Rate per Epoch')
+        plt.show()
+
+        plt.plot(tabular.rewards)
+        plt.xlabel("Number of Epochs")
+        plt.ylabel('Rewards per Epoch')
+        plt.show()
+
+        plt.plot(tabular.nums_steps)
+        plt.xlabel("Number of Epochs")
+        plt.ylabel('Number of Steps Taken per Epoch')
+        plt.show()
@@ -0,0 +1,94 @@
+from __future__ import print_function
+import os
+import time
+import numpy as np
+from maze_env import UNKNOWN, SELF
+
+
+class MazeView(object):
+    """Draws the agent's maze window, redrawing only when a cell changes.
+
+    The figure, the image artist and the gridlines are set up on the first
+    draw(); later calls set_data() on the image. On screen, only the axes
+    are blitted over the saved background, instead of the full redraw and
+    plt.pause of the old show(). With directory set, it renders offscreen
+    with the Agg backend, so pyplot and a display are never needed. In that
+    mode it writes maze_NNNNN.png at most once every interval seconds, and
+    skips other draws.
+    """
+
+    def __init__(self, directory=None, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self.figure = None
+        self.ax = None
+        self.image = None
+        self.background = None
+        self.canvas = None
+        self.last_write = 0
+        self.frames = 0
+
+    def setup(self, canvas):
+        if self.directory is None:
+            import matplotlib.pyplot as plt
+            plt.ion()
+            self.figure = plt.figure()
+        else:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.figure = Figure()
+            FigureCanvasAgg(self.figure)
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+        ax = self.figure.add_subplot(1, 1, 1)
+        nrows, ncols = canvas.shape
+        ax.set_xticks(np.arange(0.5, nrows, 1))
+        ax.set_yticks(np.arange(0.5, ncols, 1))
+        ax.set_xticklabels([])
+        ax.set_yticklabels([])
+        ax.grid(True)
+        # Fixed limits: set_data does not rescale the colours like imshow does
+        self.image = ax.imshow(canvas.transpose(), interpolation='none', cmap='gray',
+                               vmin=UNKNOWN, vmax=SELF, animated=self.directory is None)
+        ax.invert_xaxis()
+        ax.invert_yaxis()
+        self.ax = ax
+        if self.directory is None:
+            # A resize or other full redraw invalidates the saved background
+            self.figure.canvas.mpl_connect('draw_event', self.save_background)
+            self.figure.show()
+            self.figure.canvas.draw()
+            self.blit()
+
+    def save_background(self, event):
+        self.background = self.figure.canvas.copy_from_bbox(self.ax.bbox)
+
+    def blit(self):
+        figure_canvas = self.figure.canvas
+        figure_canvas.restore_region(self.background)
+        self.ax.draw_artist(self.image)
+        for line in self.ax.get_xgridlines() + self.ax.get_ygridlines():
+            self.ax.draw_artist(line)
+        figure_canvas.blit(self.ax.bbox)
+        figure_canvas.flush_events()
+
+    def draw(self, maze, position):
+        """Show maze with the agent at position; returns True if anything was drawn."""
+        if self.directory is not None and time.time() - self.last_write < self.interval:
+            return False
+        canvas = np.copy(maze)
+        canvas[position[0]][position[1]] = SELF
+        if self.image is None:
+            self.setup(canvas)
+        elif self.canvas is not None and np.array_equal(canvas, self.canvas):
+            return False
+        else:
+            self.image.set_data(canvas.transpose())
+            if self.directory is None:
+                self.blit()
+        self.canvas = canvas
+        if self.directory is not None:
+            self.figure.savefig(os.path.join(self.directory, 'maze_' + str(self.frames).zfill(5) + '.png'))
+            self.frames += 1
+            self.last_write = time.time()
+        return True
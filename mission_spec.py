@@ -0,0 +1,114 @@
+from __future__ import print_function
+from maze_env import SIZE
+from episode_reset import persistent_mission_xml
+
+MISSION_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
+            <Mission xmlns="http://ProjectMalmo.microsoft.com" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+              <About>
+                <Summary>{summary}</Summary>
+              </About>
+            <ServerSection>
+              <ServerInitialConditions>
+                <Time>
+                    <StartTime>1000</StartTime>
+                    <AllowPassageOfTime>false</AllowPassageOfTime>
+                </Time>
+                <Weather>clear</Weather>
+              </ServerInitialConditions>
+              <ServerHandlers>
+                  <FlatWorldGenerator generatorString="3;7,44*49,73,35:1,159:4,95:13,35:13,159:11,95:10,159:14,159:6,35:6,95:6;12;"/>
+                  <DrawingDecorator>
+                    <DrawSphere x="-27" y="70" z="0" radius="30" type="air"/>
+                  </DrawingDecorator>
+                  <MazeDecorator>
+                    <Seed>{seed}</Seed>
+                    <SizeAndPosition width="{size}" length="{size}" height="10" xOrigin="{origin[0]}" yOrigin="{origin[1]}" zOrigin="{origin[2]}"/>
+                    <StartBlock type="{start_block}" fixedToEdge="true"/>
+                    <EndBlock type="{end_block}" fixedToEdge="true"/>
+                    <PathBlock type="{path_block}"/>
+                    <FloorBlock type="air"/>
+                    <GapBlock type="{gap_block}"/>
+                    <GapProbability>{gap_probability}</GapProbability>
+                    <AllowDiagonalMovement>false</AllowDiagonalMovement>
+                  </MazeDecorator>
+                  <ServerQuitFromTimeUp timeLimitMs="{time_limit_ms}"/>
+                  <ServerQuitWhenAnyAgentFinishes/>
+                </ServerHandlers>
+              </ServerSection>
+              <AgentSection mode="Survival">
+                <Name>CS175AwesomeMazeBot</Name>
+                <AgentStart>
+                    <Placement x="0.5" y="56.0" z="0.5" yaw="0"/>
+                </AgentStart>
+                <AgentHandlers>
+                    <DiscreteMovementCommands/>{absolute_movement}
+                    <RewardForSendingCommand reward="{step_reward}"/>
+                    <RewardForTouchingBlockType>
+                      <Block reward="{goal_reward}" type="{end_block}" behaviour="onceOnly"/>{gap_reward}
+                    </RewardForTouchingBlockType>
+                    <AgentQuitFromTouchingBlockType>{quit_blocks}
+                    </AgentQuitFromTouchingBlockType>
+                    <ObservationFromGrid>
+                      <Grid name="floorAll">
+                        <min x="-{grid_radius}" y="-1" z="-{grid_radius}"/>
+                        <max x="{grid_radius}" y="-1" z="{grid_radius}"/>
+                      </Grid>
+                  </ObservationFromGrid>{full_stats}
+                </AgentHandlers>
+              </AgentSection>
+            </Mission>'''
+
+
+def mission_xml(size=SIZE, seed=0, gap_probability=0.5, origin=(-32, 69, -5),
+                gap_block='stone', path_block='diamond_block', start_block='emerald_block',
+                end_block='redstone_block', grid_radius=SIZE, quit_blocks=None,
+                step_reward=-1, goal_reward=100, gap_reward=None,
+                absolute_movement=True, full_stats=False, time_limit_ms=10000,
+                summary='Running Maze', persistent=False):
+    """MazeDecorator mission XML for the maze agents.
+
+    quit_blocks defaults to the end and gap blocks; gap_reward, if set, is
+    given for touching a gap block. The floorAll grid spans grid_radius
+    blocks around the agent (10 gives the 21x21 window). With persistent
+    set the quit handlers are swapped for MissionQuitCommands, as in
+    episode_reset.persistent_mission_xml.
+    """
+    if quit_blocks is None:
+        quit_blocks = (end_block, gap_block)
+    xml = MISSION_TEMPLATE.format(
+        summary=summary, seed=seed, size=size, origin=origin, start_block=start_block,
+        end_block=end_block, path_block=path_block, gap_block=gap_block,
+        gap_probability=gap_probability, time_limit_ms=time_limit_ms,
+        absolute_movement='\n                    <AbsoluteMovementCommands/>' if absolute_movement else '',
+        step_reward=step_reward, goal_reward=goal_reward,
+        gap_reward='' if gap_reward is None else
+        '\n                      <Block reward="%s" type="%s" behaviour="onceOnly"/>' % (gap_reward, gap_block),
+        quit_blocks=''.join('\n                        <Block type="%s"/>' % block for block in quit_blocks),
+        grid_radius=grid_radius,
+        full_stats='\n                  <ObservationFromFullStats/>' if full_stats else '')
+    if persistent:
+        xml = persistent_mission_xml(xml)
+    return xml
+
+
+specs = {}
+
+
+def mission_spec(video=None, viewpoint=None, **params):
+    """Validated MalmoPython.MissionSpec for mission_xml(**params), built once.
+
+    Specs are cached by their parameters, so only the first mission of a
+    configuration pays for building and schema-validating the XML. video
+    is an optional (width, height) for requestVideo, with viewpoint for
+    setViewpoint.
+    """
+    key = (video, viewpoint, tuple(sorted(params.items())))
+    if key not in specs:
+        import MalmoPython
+        spec = MalmoPython.MissionSpec(mission_xml(**params), True)
+        if video is not None:
+            spec.requestVideo(*video)
+        if viewpoint is not None:
+            spec.setViewpoint(viewpoint)
+        specs[key] = spec
+    return specs[key]
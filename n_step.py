@@ -0,0 +1,62 @@
+from __future__ import print_function
+
+
+class DiscountedWindow(object):
+    """FIFO of rewards that keeps sum(gamma ** i * reward_i) from the oldest one.
+
+    Rewards are appended to a back stack whose discounted sum is kept as they
+    arrive. When the oldest reward is popped and the front stack is empty,
+    the back stack is moved over and every entry stores the discounted
+    return of itself and the entries newer than it in the front stack. total()
+    joins the two halves, so append, popleft and total are O(1) amortised
+    whatever the window length. Nothing is ever subtracted or divided by
+    gamma, so rounding errors do not build up over long episodes.
+    """
+
+    def __init__(self, gamma):
+        self.gamma = gamma
+        # (reward, return from this entry on, gamma ** entries from this one on)
+        self.front = []
+        self.back = []
+        self.back_return = 0.0
+        self.back_discount = 1.0
+        self.last = None
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i < len(self.front):
+            return self.front[-1 - i][0]
+        return self.back[i - len(self.front)]
+
+    def append(self, reward):
+        self.last = reward
+        self.back.append(reward)
+        self.back_return += self.back_discount * reward
+        self.back_discount *= self.gamma
+
+    def popleft(self):
+        if not self.front:
+            if len(self.back) == 1:
+                self.back_return = 0.0
+                self.back_discount = 1.0
+                return self.back.pop()
+            G, discount = 0.0, 1.0
+            for reward in reversed(self.back):
+                G = reward + self.gamma * G
+                discount *= self.gamma
+                self.front.append((reward, G, discount))
+            self.back = []
+            self.back_return = 0.0
+            self.back_discount = 1.0
+        return self.front.pop()[0]
+
+    def total(self):
+        """Discounted return of the rewards in the window, oldest first."""
+        if not self.front:
+            return self.back_return
+        _, G, discount = self.front[-1]
+        return G + discount * self.back_return
@@ -0,0 +1,125 @@
+from __future__ import print_function
+import numpy as np
+from maze_env import ACTIONS, MAP_LENGTH, MAP_WIDTH
+
+
+def weight_shapes(inputs=MAP_LENGTH * MAP_WIDTH, hidden=MAP_LENGTH * MAP_WIDTH, outputs=len(ACTIONS)):
+    """Shapes of build_model's weights in model.get_weights() order."""
+    return [(inputs, hidden), (hidden, ), (hidden, ),
+            (hidden, hidden), (hidden, ), (hidden, ),
+            (hidden, outputs), (outputs, )]
+
+
+def load_h5_weights(filename):
+    """Weights of a Keras save_weights (or model.save) .h5 file, in layer order.
+
+    Needs h5py, but not Keras or TensorFlow.
+    """
+    import h5py
+    with h5py.File(filename, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        weights = []
+        for layer in group.attrs['layer_names']:
+            layer = group[layer.decode('utf8') if isinstance(layer, bytes) else layer]
+            for name in layer.attrs['weight_names']:
+                weights.append(layer[name.decode('utf8') if isinstance(name, bytes) else name][()])
+    return weights
+
+
+# Keras layer and weight names of build_model's network, as its save_weights writes them
+H5_LAYERS = [('dense_1', ['kernel', 'bias']), ('p_re_lu_1', ['alpha']),
+             ('dense_2', ['kernel', 'bias']), ('p_re_lu_2', ['alpha']),
+             ('dense_3', ['kernel', 'bias'])]
+
+
+def save_h5_weights(filename, weights):
+    """Write weights (get_weights() order) in the layout of Keras save_weights.
+
+    build_model's load_weights and load_h5_weights both read the file back.
+    """
+    import h5py
+    weights = iter(weights)
+    with h5py.File(filename, 'w') as f:
+        f.attrs['layer_names'] = np.array([layer for layer, _ in H5_LAYERS], dtype='S')
+        f.attrs['backend'] = b'tensorflow'
+        f.attrs['keras_version'] = b'2.2.4'
+        for layer, names in H5_LAYERS:
+            group = f.create_group(layer)
+            weight_names = ['%s/%s:0' % (layer, name) for name in names]
+            group.attrs['weight_names'] = np.array(weight_names, dtype='S')
+            for name in weight_names:
+                group.create_dataset(name, data=next(weights))
+
+
+class NumpyNet(object):
+    """Forward pass of build_model's Dense/PReLU/Dense/PReLU/Dense network in NumPy.
+
+    Takes the weights in Keras get_weights() order and answers predict()
+    with three float32 matmuls, so acting needs neither Keras nor
+    TensorFlow. It also has get_weights/set_weights, so it can stand in for
+    the acting copy of a model (async_learner, inference_server, actors).
+    Weights load from a Keras .h5 file or from a flat float32 .npy file
+    written by save_flat, which loads without h5py.
+    """
+
+    def __init__(self, weights):
+        self.set_weights(weights)
+
+    @classmethod
+    def from_h5(cls, filename):
+        return cls(load_h5_weights(filename))
+
+    @classmethod
+    def from_flat(cls, filename, mmap_mode=None):
+        flat = np.load(filename, mmap_mode=mmap_mode)
+        weights = []
+        start = 0
+        for shape in weight_shapes():
+            size = int(np.prod(shape))
+            weights.append(flat[start:start + size].reshape(shape))
+            start += size
+        return cls(weights)
+
+    def save_weights(self, filename, overwrite=True):
+        """Save to a Keras .h5 weights file, so the acting copy can be checkpointed."""
+        save_h5_weights(filename, self.get_weights())
+
+    def save_flat(self, filename):
+        np.save(filename, np.concatenate([weight.ravel() for weight in self.get_weights()]))
+
+    def get_weights(self):
+        return [self.w1, self.b1, self.alpha1, self.w2, self.b2, self.alpha2, self.w3, self.b3]
+
+    def set_weights(self, weights):
+        (self.w1, self.b1, self.alpha1, self.w2, self.b2, self.alpha2,
+         self.w3, self.b3) = [np.asarray(weight, dtype=np.float32) for weight in weights]
+
+    def predict(self, x, **kwargs):
+        h = np.dot(np.asarray(x, dtype=np.float32), self.w1)
+        h += self.b1
+        h = np.where(h > 0, h, self.alpha1 * h)
+        h = np.dot(h, self.w2)
+        h += self.b2
+        h = np.where(h > 0, h, self.alpha2 * h)
+        h = np.dot(h, self.w3)
+        h += self.b3
+        return h
+
+
+class NumpyPolicy(object):
+    """Act for agent through a NumpyNet copy of agent.model.
+
+    predict() answers like agent.predict without a Keras call; refresh()
+    copies the model's weights back in after each train(), so the copy
+    never acts on stale weights.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.net = NumpyNet(agent.model.get_weights())
+
+    def predict(self, canvas):
+        return self.net.predict(canvas)[0]
+
+    def refresh(self):
+        self.net.set_weights(self.agent.model.get_weights())
@@ -0,0 +1,101 @@
+from __future__ import print_function
+import json
+import time
+import numpy as np
+
+clock = getattr(time, 'perf_counter', time.time)
+
+PHASES = ('send', 'wait', 'decode', 'act', 'learn', 'checkpoint', 'render')
+# Histogram bin edges in seconds, four per doubling from 1 us to about 2 minutes
+BINS = 1e-6 * 2 ** (np.arange(0, 27 * 4 + 1) / 4.0)
+
+
+class NullProbe(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_PROBE = NullProbe()
+
+
+class Probe(object):
+    """Times each with-block; start times are stacked, so a phase may nest inside itself."""
+    __slots__ = ('samples', 'starts')
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(clock())
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(clock() - self.starts.pop())
+        return False
+
+
+class PhaseTimer(object):
+    """Times phases of the training loop: with timer.phase('wait'): ...
+
+    Durations are kept per phase until end_episode(), which turns them into
+    a count, total, percentiles and a log-spaced histogram: nonzero [bin,
+    count] pairs, where bin b holds durations from BINS[b - 1] up to BINS[b].
+    It appends them as one JSON line to filename.
+    The timer is enabled by giving a filename, or with enabled=True. When
+    disabled, phase() returns a shared do-nothing probe, which costs about
+    a method call. A phase nested in itself is timed at every level, so its
+    total counts the inner time twice. Use one timer per thread.
+    """
+
+    def __init__(self, filename=None, enabled=None):
+        self.filename = filename
+        self.enabled = filename is not None if enabled is None else enabled
+        self.probes = {}
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PROBE
+        probe = self.probes.get(name)
+        if probe is None:
+            probe = self.probes[name] = Probe([])
+        return probe
+
+    def summary(self):
+        """Statistics of each phase timed since the last end_episode, in seconds."""
+        phases = {}
+        for name, probe in self.probes.items():
+            if not probe.samples:
+                continue
+            samples = np.array(probe.samples)
+            p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+            counts = np.bincount(np.searchsorted(BINS, samples), minlength=len(BINS) + 1)
+            # Rounded to 0.1 us, which keeps the metrics file short
+            phases[name] = dict(count=len(samples), total=round(float(samples.sum()), 7),
+                                p50=round(float(p50), 7), p90=round(float(p90), 7),
+                                p99=round(float(p99), 7), max=round(float(samples.max()), 7),
+                                histogram=[[int(b), int(counts[b])] for b in np.flatnonzero(counts)])
+        return phases
+
+    def end_episode(self, episode):
+        """Write and return the summary of episode, then start timing the next one."""
+        if not self.enabled:
+            return None
+        record = dict(episode=episode, phases=self.summary())
+        for probe in self.probes.values():
+            del probe.samples[:]
+        if self.filename is not None:
+            with open(self.filename, 'a') as outfile:
+                outfile.write(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+        return record
+
+
+def read_phases(filename):
+    """Records written by PhaseTimer.end_episode, oldest first."""
+    with open(filename, 'r') as infile:
+        return [json.loads(line) for line in infile if line.strip()]
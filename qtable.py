@@ -0,0 +1,173 @@
+from __future__ import print_function
+import json
+import os
+import struct
+import numpy as np
+from maze_env import ACTIONS, MAP_LENGTH, MAP_WIDTH
+
+
+def mask_filename(filename):
+    return filename + '.mask.npy'
+
+
+def snapshot_filename(filename):
+    """QTableLog's snapshot: values and mask in one .npz, so it is replaced in one rename."""
+    return filename + '.npz'
+
+
+class QTable(object):
+    """Dense Q-table indexed by (x, z, action).
+
+    values is a float32 array and valid marks the (x, z, action) entries the
+    agent has initialised, which is what the old dict-of-dicts table held as
+    keys. Both arrays are saved as .npy files (filename + '.npy' and
+    filename + '.mask.npy') and can be memory-mapped with open(), in which
+    case flush() is all a checkpoint needs. JSON stays as an import/export
+    format for tables written by earlier versions.
+    """
+
+    def __init__(self, values=None, valid=None, shape=(MAP_LENGTH, MAP_WIDTH, len(ACTIONS))):
+        self.values = np.zeros(shape, dtype=np.float32) if values is None else values
+        self.valid = np.zeros(self.values.shape, dtype=np.bool_) if valid is None else valid
+
+    def __len__(self):
+        """Number of states with at least one initialised action."""
+        return int(np.count_nonzero(self.valid.any(axis=2)))
+
+    def save(self, filename):
+        np.save(filename + '.npy', self.values)
+        np.save(mask_filename(filename), self.valid)
+
+    @classmethod
+    def load(cls, filename, mmap_mode=None):
+        return cls(np.load(filename + '.npy', mmap_mode=mmap_mode),
+                   np.load(mask_filename(filename), mmap_mode=mmap_mode))
+
+    @classmethod
+    def open(cls, filename, shape=(MAP_LENGTH, MAP_WIDTH, len(ACTIONS))):
+        """Memory-map filename's table read-write, creating it if needed."""
+        if os.path.exists(filename + '.npy'):
+            return cls.load(filename, mmap_mode='r+')
+        return cls(np.lib.format.open_memmap(filename + '.npy', mode='w+', dtype=np.float32, shape=shape),
+                   np.lib.format.open_memmap(mask_filename(filename), mode='w+', dtype=np.bool_, shape=shape))
+
+    def flush(self):
+        for array in (self.values, self.valid):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    @classmethod
+    def from_json(cls, table):
+        """Import the {"[x, z]": {"action": value}} dict written by json.dump."""
+        q_table = cls()
+        for state, actions in table.items():
+            try:
+                x, z = json.loads(state)
+            except ValueError:
+                continue  # 'Term State'
+            for action, value in actions.items():
+                q_table.values[x, z, int(action)] = value
+                q_table.valid[x, z, int(action)] = True
+        return q_table
+
+    def to_json(self):
+        """Export as the {"[x, z]": {action: value}} dict Tabular used to keep."""
+        table = {}
+        for x, z, action in zip(*np.nonzero(self.valid)):
+            table.setdefault(str([int(x), int(z)]), {})[int(action)] = float(self.values[x, z, action])
+        return table
+
+
+# One logged write: x, z, action, new value
+LOG_RECORD = np.dtype([('x', 'u1'), ('z', 'u1'), ('action', 'u1'), ('value', '<f4')])
+LOG_STRUCT = struct.Struct('<BBBf')
+
+
+def replace_file(source, destination):
+    """Atomically move source over destination once its bytes are on disk."""
+    with open(source, 'rb+') as outfile:
+        os.fsync(outfile.fileno())
+    getattr(os, 'replace', os.rename)(source, destination)
+
+
+class QTableLog(object):
+    """Write-ahead log of Q-table updates on top of a QTable snapshot.
+
+    record() appends a fixed-size record through a buffered file, so a
+    checkpoint (flush) costs as much as the updates made since the last one
+    rather than a rewrite of the table. Every compact_every records the
+    table is compacted: written to a temporary .npz, renamed over the
+    snapshot and the log truncated. Records store absolute values, so
+    replaying a log over a snapshot that already contains some of it is
+    harmless, and a torn last record from a crash is ignored. Replayed
+    entries are marked valid; entries only initialised (never written)
+    since the last compaction come back as uninitialised zeros.
+    """
+
+    def __init__(self, filename, q_table, compact_every=100000, buffering=1 << 16):
+        self.filename = filename
+        self.q_table = q_table
+        self.compact_every = compact_every
+        self.buffering = buffering
+        self.records = 0
+        self.logfile = open(filename + '.log', 'ab', buffering)
+
+    @classmethod
+    def open(cls, filename, compact_every=100000):
+        """Load filename's snapshot (if any) and replay its log onto it.
+
+        The snapshot is filename + '.npz', or else a QTable.save()d .npy pair
+        (as imported from JSON). Temporary files left by a crashed compaction
+        are removed: the log still holds their updates.
+        """
+        directory, name = os.path.split(filename)
+        for stale in os.listdir(directory or '.'):
+            if stale.startswith(name + '.tmp'):
+                os.remove(os.path.join(directory, stale))
+        if os.path.exists(snapshot_filename(filename)):
+            with np.load(snapshot_filename(filename)) as snapshot:
+                q_table = QTable(snapshot['values'], snapshot['valid'])
+        elif os.path.exists(filename + '.npy'):
+            q_table = QTable.load(filename)
+        else:
+            q_table = QTable()
+        if os.path.exists(filename + '.log'):
+            with open(filename + '.log', 'rb') as infile:
+                data = infile.read()
+            usable = len(data) - len(data) % LOG_RECORD.itemsize
+            records = np.frombuffer(data[:usable], dtype=LOG_RECORD)
+            # Keep only the newest write of each entry
+            cells = np.ravel_multi_index((records['x'], records['z'], records['action']),
+                                         q_table.values.shape)
+            _, newest = np.unique(cells[::-1], return_index=True)
+            records = records[len(records) - 1 - newest]
+            q_table.values[records['x'], records['z'], records['action']] = records['value']
+            q_table.valid[records['x'], records['z'], records['action']] = True
+        log = cls(filename, q_table, compact_every)
+        log.compact()
+        return log
+
+    def record(self, x, z, action, value):
+        self.logfile.write(LOG_STRUCT.pack(x, z, action, value))
+        self.records += 1
+
+    def flush(self):
+        """Hand buffered records to the OS; compact once enough have piled up."""
+        self.logfile.flush()
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        self.logfile.flush()
+        os.fsync(self.logfile.fileno())
+        with open(snapshot_filename(self.filename + '.tmp'), 'wb') as outfile:
+            np.savez(outfile, values=self.q_table.values, valid=self.q_table.valid)
+        replace_file(snapshot_filename(self.filename + '.tmp'), snapshot_filename(self.filename))
+        # The snapshot now holds every logged write, so the log can start over
+        self.logfile.close()
+        self.logfile = open(self.filename + '.log', 'wb', self.buffering)
+        self.records = 0
+
+    def close(self):
+        self.compact()
+        self.logfile.close()
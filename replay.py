@@ -0,0 +1,178 @@
+from __future__ import print_function
+import random
+import numpy as np
+
+
+def allocate(filename, shape, dtype):
+    if filename is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode='w+', shape=shape, dtype=dtype)
+
+
+class ReplayMemory(object):
+    """Fixed-capacity ring buffer of (canvas, action, reward, canvas_next, game_over).
+
+    Transitions live in preallocated arrays, so inserting is O(1) and the
+    oldest entry is overwritten once the buffer is full. Canvases only hold
+    the maze codes 0-4 and are stored as int8. With filename set, every
+    array is a memory-mapped .npy file (filename + '_states.npy', ...) and
+    long runs stay off the Python heap.
+    """
+
+    def __init__(self, capacity, state_size=441, filename=None, state_dtype=np.int8):
+        self.capacity = capacity
+
+        def path(name):
+            return None if filename is None else filename + '_' + name + '.npy'
+
+        self.states = allocate(path('states'), (capacity, state_size), state_dtype)
+        self.actions = allocate(path('actions'), (capacity, ), np.uint8)
+        self.rewards = allocate(path('rewards'), (capacity, ), np.float32)
+        self.next_states = allocate(path('next_states'), (capacity, state_size), state_dtype)
+        self.dones = allocate(path('dones'), (capacity, ), np.bool_)
+        self.index = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, canvas, action, reward, canvas_next, game_over):
+        i = self.index
+        self.states[i] = np.reshape(canvas, -1)
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = np.reshape(canvas_next, -1)
+        self.dones[i] = game_over
+        self.index = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return i
+
+    def extend(self, canvases, actions, rewards, canvases_next, game_overs):
+        """Append a batch of transitions (one row each) at once."""
+        n = len(actions)
+        if n > self.capacity:
+            return self.extend(*[column[-self.capacity:] for column in
+                                 (canvases, actions, rewards, canvases_next, game_overs)])
+        rows = (self.index + np.arange(n)) % self.capacity
+        self.states[rows] = canvases
+        self.actions[rows] = actions
+        self.rewards[rows] = rewards
+        self.next_states[rows] = canvases_next
+        self.dones[rows] = game_overs
+        self.index = (self.index + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+        return rows
+
+    def get(self, rows):
+        """Return (canvases, actions, rewards, canvases_next, game_overs) for rows."""
+        return (self.states[rows].astype(np.float32), self.actions[rows].astype(np.int64),
+                self.rewards[rows], self.next_states[rows].astype(np.float32), self.dones[rows])
+
+    def sample_rows(self, batch_size):
+        """Pick min(batch_size, len(self)) distinct rows uniformly.
+
+        Returns (rows, weights); uniform sampling needs no importance-sampling
+        weights, so weights is None.
+        """
+        return np.array(random.sample(range(self.size), min(batch_size, self.size))), None
+
+    def sample(self, batch_size):
+        return self.get(self.sample_rows(batch_size)[0])
+
+    def update_priorities(self, rows, errors):
+        pass
+
+
+class SumTree(object):
+    """Binary tree of priorities where every node holds the sum of its children.
+
+    Leaves sit at [leaves, 2 * leaves) of one flat array and the root at 1,
+    so updating a priority and finding the leaf for a prefix sum both walk a
+    single root-to-leaf path: O(log n), done for a whole batch at once.
+    """
+
+    def __init__(self, capacity):
+        self.leaves = 1
+        self.depth = 0
+        while self.leaves < capacity:
+            self.leaves *= 2
+            self.depth += 1
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def priorities(self, rows):
+        return self.tree[np.asarray(rows) + self.leaves]
+
+    def update(self, rows, priorities):
+        nodes = np.asarray(rows) + self.leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Leaf index whose prefix-sum interval holds each of values."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            right = values >= self.tree[left]
+            values -= np.where(right, self.tree[left], 0)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """ReplayMemory that samples transitions in proportion to their TD error.
+
+    Priorities are (|error| + epsilon) ** alpha and live in a SumTree; new
+    transitions get the largest priority seen so far so each is replayed at
+    least once. sample_rows returns importance-sampling weights, normalised
+    to a maximum of 1, for the fit call. Their exponent beta is annealed
+    linearly from beta to 1 over beta_steps calls (held at beta if
+    beta_steps is 0), so the bias correction is complete late in training.
+    """
+
+    def __init__(self, capacity, state_size=441, filename=None, state_dtype=np.int8,
+                 alpha=0.6, beta=0.4, epsilon=0.01, beta_steps=100000):
+        ReplayMemory.__init__(self, capacity, state_size, filename, state_dtype)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_start = beta
+        self.beta_steps = beta_steps
+        self.samples = 0
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+
+    def append(self, canvas, action, reward, canvas_next, game_over):
+        i = ReplayMemory.append(self, canvas, action, reward, canvas_next, game_over)
+        self.tree.update([i], self.max_priority)
+        return i
+
+    def extend(self, canvases, actions, rewards, canvases_next, game_overs):
+        rows = ReplayMemory.extend(self, canvases, actions, rewards, canvases_next, game_overs)
+        self.tree.update(rows, self.max_priority)
+        return rows
+
+    def sample_rows(self, batch_size):
+        batch_size = min(batch_size, self.size)
+        # One uniform draw per equal slice of the total priority
+        total = self.tree.total()
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * (total / batch_size)
+        rows = np.minimum(self.tree.find(values), self.size - 1)
+
+        probabilities = self.tree.priorities(rows) / total
+        weights = (self.size * probabilities) ** -self.beta
+        self.samples += 1
+        if self.beta_steps:
+            progress = min(1.0, self.samples / float(self.beta_steps))
+            self.beta = self.beta_start + (1.0 - self.beta_start) * progress
+        return rows, (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, rows, errors):
+        priorities = (np.abs(errors) + self.epsilon) ** self.alpha
+        self.tree.update(rows, priorities)
+        self.max_priority = max(self.max_priority, float(np.max(priorities)))
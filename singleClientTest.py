@@ -1,10 +1,11 @@
 import time
 import threading
-import MalmoPython
 import random
 import json
 from collections import defaultdict
-import tensorflow as tf
+from startup import LazyModule
+
+MalmoPython = LazyModule('MalmoPython')
 
 
 ARENA_WIDTH = 60
@@ -0,0 +1,42 @@
+from __future__ import print_function
+import importlib
+import json
+import os
+
+
+class LazyModule(object):
+    """Stands in for a module and imports it the first time an attribute is used.
+
+    plt = LazyModule('matplotlib.pyplot') keeps matplotlib out of start-up
+    for runs that never plot; the same goes for PIL and MalmoPython.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            self.__dict__['_lazy_module'] = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+
+def save_model_json(model, filename):
+    """json.dump(model.to_json()) to filename unless it already holds that.
+
+    Returns True if the file was written.
+    """
+    text = json.dumps(model.to_json())
+    if os.path.exists(filename):
+        with open(filename, 'r') as infile:
+            if infile.read() == text:
+                return False
+    with open(filename, 'w') as outfile:
+        outfile.write(text)
+    return True
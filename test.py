@@ -1,7 +1,9 @@
 import time
 import threading
-import MalmoPython
 import random
+from startup import LazyModule
+
+MalmoPython = LazyModule('MalmoPython')
 
 
 def drawMobs(num_mobs):
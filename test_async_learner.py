@@ -0,0 +1,53 @@
+from __future__ import print_function
+import threading
+import numpy as np
+import pytest
+from async_learner import BackgroundLearner
+
+
+class Model(object):
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def get_weights(self):
+        return list(self.weights)
+
+    def set_weights(self, weights):
+        self.weights = list(weights)
+
+
+class Agent(object):
+
+    def __init__(self):
+        self.model = Model([np.ones((2, 2), np.float32)])
+        self.memory = []
+
+    def memorize(self, status):
+        self.memory.append(status)
+
+
+def test_call_runs_on_the_learner_thread():
+    """Maze.initialize's warm-start pretrain fits agent.model on the learner thread."""
+    agent = Agent()
+    threads = []
+
+    def train(updates):
+        threads.append(threading.current_thread())
+
+    def pretrain():
+        threads.append(threading.current_thread())
+        agent.model.set_weights([np.full((2, 2), 2, np.float32)])
+        return 0.5
+
+    learner = BackgroundLearner(agent, train, Model([np.zeros((2, 2), np.float32)])).start()
+    learner.push(None)
+    try:
+        assert learner.call(pretrain) == 0.5
+        with pytest.raises(ZeroDivisionError):
+            learner.call(lambda: 1 / 0)
+    finally:
+        learner.stop()
+    assert set(threads) == {learner.thread}
+    learner.refresh()
+    assert (learner.acting_model.get_weights()[0] == 2).all()
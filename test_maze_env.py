@@ -0,0 +1,13 @@
+from __future__ import print_function
+import pytest
+from maze_env import SIZE, MazeEnv, BatchMazeEnv
+
+
+def test_size_must_fit_the_window():
+    for size in (1, SIZE + 1):
+        MazeEnv(size=size, seed=size)
+    for size in (0, SIZE + 2):
+        with pytest.raises(ValueError, match='between 1 and %d' % (SIZE + 1)):
+            MazeEnv(size=size)
+        with pytest.raises(ValueError, match='between 1 and %d' % (SIZE + 1)):
+            BatchMazeEnv(0, size=size)
@@ -0,0 +1,107 @@
+from __future__ import print_function
+import random
+import types
+from collections import deque
+import numpy as np
+import maze_tabular
+from maze_env import MAP_LENGTH, MAP_WIDTH
+from maze_tabular import Tabular
+from n_step import DiscountedWindow
+
+GAMMAS = (0.6, 0.9, 0.99)
+WINDOWS = (1, 2, 5, 50)
+
+
+def summed_return(rewards, gamma):
+    return sum(gamma ** i * reward for i, reward in enumerate(rewards))
+
+
+def test_window_matches_summed_return():
+    rng = random.Random(0)
+    for gamma in GAMMAS:
+        for n in WINDOWS:
+            window, reference = DiscountedWindow(gamma), deque()
+            for _ in range(2000):
+                reward = rng.choice([-2, -1, 0, 2, 100, -50]) * rng.random()
+                window.append(reward)
+                reference.append(reward)
+                while len(reference) > n or (reference and rng.random() < 0.1):
+                    assert window.popleft() == reference.popleft()
+                assert len(window) == len(reference)
+                assert list(window[i] for i in range(len(window))) == list(reference)
+                assert window.last == reward
+                assert np.isclose(window.total(), summed_return(reference, gamma), rtol=1e-12, atol=1e-9)
+
+
+def update_q_table_sum(self, tau, S, A, R, T):
+    """Tabular.update_q_table before n_step: the n-step return summed every time.
+
+    Also the reference bench.bench_n_step times the rolling update against.
+    """
+    curr_s, curr_a, curr_r = S.popleft(), A.popleft(), R.popleft()
+    G = sum([self.gamma ** i * R[i] for i in range(len(S))])
+
+    n = self.positive_n if R[-1] > 0 else self.negative_n
+    if tau + n < T:
+        G += self.gamma ** n * self.q_table.values[S[-1] + (A[-1], )]
+
+    old_q = self.q_table.values[curr_s + (curr_a, )]
+    self.q_table.values[curr_s + (curr_a, )] = old_q + self.alpha * (G - old_q)
+
+
+def scripted_tabular(episodes, gamma, n, window, update=None):
+    """Q-values after Tabular.play plays episodes, lists of (position, action, reward).
+
+    The first entry is the start and its action; every later one is where a
+    step led (None when the episode ended), its reward and the next action.
+    """
+    tabular = Tabular(alpha=0.3, gamma=gamma)
+    tabular.negative_n = n
+    tabular.positive_n = n + 4
+    tabular.boundary = [0, 0, MAP_LENGTH - 1, MAP_WIDTH - 1]
+    if update is not None:
+        tabular.update_q_table = types.MethodType(update, tabular)
+    maze_tabular.DiscountedWindow = window
+    try:
+        for episode in episodes:
+            actions = iter([action for position, action, _ in episode if position is not None])
+            steps = iter(episode[1:])
+            tabular.choose_action = lambda state, possible_actions: next(actions)
+
+            def act(action):
+                position, _, reward = next(steps)
+                if position is not None:
+                    tabular.position = list(position)
+                return [position is None, reward]
+            tabular.position = list(episode[0][0])
+            tabular.play(act)
+    finally:
+        maze_tabular.DiscountedWindow = DiscountedWindow
+    return tabular.q_table.values
+
+
+def random_episodes(number, length=80, seed=0):
+    """number episodes of up to length steps, in the format scripted_tabular plays."""
+    rng = random.Random(seed)
+    episodes = []
+    for _ in range(number):
+        episode = []
+        for _ in range(rng.randint(1, length)):
+            episode.append(((rng.randrange(MAP_LENGTH), rng.randrange(MAP_WIDTH)), rng.randrange(4),
+                            rng.choice([-2, -2, -2, 5])))
+        episode.append((None, 0, rng.choice([-50, 100])))
+        episodes.append(episode)
+    return episodes
+
+
+def test_play_matches_summed_update():
+    """Every update of Tabular.play, the episode-end flush included, against the summed return."""
+    episodes = random_episodes(40)
+    for gamma in GAMMAS:
+        for n in WINDOWS:
+            rolling = scripted_tabular(episodes, gamma, n, DiscountedWindow)
+            summed = scripted_tabular(episodes, gamma, n, lambda gamma: deque(), update_q_table_sum)
+            assert (rolling != 0).any()
+            assert np.allclose(rolling, summed, rtol=1e-5, atol=1e-4), (gamma, n)
+            if n == 1:
+                assert (rolling == summed).all()
@@ -0,0 +1,35 @@
+from __future__ import print_function
+import os
+import numpy as np
+import maze
+import maze2
+from async_learner import BackgroundLearner
+from numpy_net import NumpyNet, load_h5_weights
+
+WEIGHTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weights.h5')
+
+
+def test_save_weights_round_trip(tmp_path):
+    filename = str(tmp_path / 'weights.h5')
+    NumpyNet.from_h5(WEIGHTS).save_weights(filename, overwrite=True)
+    for saved, original in zip(load_h5_weights(filename), load_h5_weights(WEIGHTS)):
+        assert saved.dtype == original.dtype and (saved == original).all()
+
+
+def test_checkpoint_with_async_learning_and_numpy_inference(tmp_path, monkeypatch):
+    """The per-episode checkpoint saves the learner's NumpyNet acting copy."""
+    canvas = np.random.RandomState(0).randint(0, 5, (1, 441)).astype(np.float32)
+    for module in (maze, maze2):
+        monkeypatch.setattr(module, 'numpy_inference', True)
+        agent = module.iKun(NumpyNet.from_h5(WEIGHTS), memory_length=10)
+        learner = BackgroundLearner(agent, lambda updates: None, module.acting_copy(agent.model))
+        assert isinstance(learner.acting_model, NumpyNet)
+        # Weights the learner published since the acting copy was made
+        learner.weights = [weight * 0.5 for weight in agent.model.get_weights()]
+        learner.refresh()
+
+        filename = str(tmp_path / (module.__name__ + '.h5'))
+        module.save_weights(agent, learner, filename)
+        saved = NumpyNet.from_h5(filename)
+        assert np.allclose(saved.predict(canvas), learner.acting_model.predict(canvas))
+        assert not np.allclose(saved.predict(canvas), agent.model.predict(canvas))
@@ -0,0 +1,52 @@
+from __future__ import print_function
+import os
+import numpy as np
+import pytest
+import qtable
+from qtable import QTable, QTableLog
+
+
+def write(log, x, z, action, value):
+    """Update the table and log the write, as Tabular.update_q_table does."""
+    log.q_table.values[x, z, action] = value
+    log.q_table.valid[x, z, action] = True
+    log.record(x, z, action, value)
+
+
+@pytest.mark.parametrize('renames', [0, 1])
+def test_open_after_crash_in_compact(tmp_path, monkeypatch, renames):
+    """A first compaction that dies after some of its renames leaves a table open() can load."""
+    filename = str(tmp_path / 'table')
+    log = QTableLog(filename, QTable())
+    write(log, 1, 2, 3, 4.0)
+    write(log, 5, 6, 0, -1.0)
+    log.flush()
+
+    replace_file = qtable.replace_file
+    done = []
+
+    def crash(source, destination):
+        if len(done) == renames:
+            raise OSError("crashed before renaming " + source)
+        replace_file(source, destination)
+        done.append(destination)
+    monkeypatch.setattr(qtable, 'replace_file', crash)
+    try:
+        log.compact()
+    except OSError:
+        pass
+    log.logfile.close()
+    monkeypatch.undo()
+
+    q_table = QTableLog.open(filename).q_table
+    assert q_table.values[1, 2, 3] == 4.0 and q_table.values[5, 6, 0] == -1.0
+    assert np.count_nonzero(q_table.valid) == 2
+    assert not any(name.startswith('table.tmp') for name in os.listdir(str(tmp_path)))
+
+
+def test_open_imported_table(tmp_path):
+    """A QTable.save()d .npy pair, as imported from JSON, is the snapshot until the first compaction."""
+    filename = str(tmp_path / 'table')
+    QTable.from_json({'[3, 4]': {'2': 0.5}, 'Term State': {}}).save(filename)
+    q_table = QTableLog.open(filename).q_table
+    assert q_table.values[3, 4, 2] == 0.5 and len(q_table) == 1
@@ -0,0 +1,182 @@
+from __future__ import print_function
+import os
+import threading
+import numpy as np
+from maze_env import DELTAS, SELF, MAP_LENGTH, MAP_WIDTH
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# One raw file per column, rows appended in order
+STEP_COLUMNS = [('positions', np.int16, (2, )), ('actions', np.uint8, ()),
+                ('rewards', np.float32, ()), ('dones', np.uint8, ())]
+EPISODE_COLUMNS = [('starts', np.int64, ()), ('layouts', np.int8, (MAP_LENGTH, MAP_WIDTH))]
+
+
+def row_size(dtype, shape):
+    return np.dtype(dtype).itemsize * int(np.prod(shape))
+
+
+def complete_rows(directory, columns):
+    """Rows present in every column file; a torn tail row is not counted."""
+    rows = []
+    for name, dtype, shape in columns:
+        path = os.path.join(directory, name)
+        rows.append(os.path.getsize(path) // row_size(dtype, shape) if os.path.exists(path) else 0)
+    return min(rows)
+
+
+def recorded_episodes(directory, steps):
+    """Episodes that start before step row steps; later ones lost their steps in a crash."""
+    path = os.path.join(directory, 'starts')
+    if not os.path.exists(path):
+        return 0
+    starts = np.fromfile(path, dtype=np.int64)[:complete_rows(directory, EPISODE_COLUMNS)]
+    return int(np.searchsorted(starts, steps, side='left'))
+
+
+class TrajectoryWriter(object):
+    """Stream every step of every episode to directory, one binary file per column.
+
+    Each step is its position before the move (int16 x, z), the action
+    (uint8), the reward (float32) and the done flag (uint8): 10 bytes, so a
+    million steps take about 10 MB. The decoded layout (int8, 21x21) and
+    the first step of each episode are stored once per episode. Rows are
+    buffered and written chunk rows at a time, and on flush() and close().
+    Opening an existing directory appends to it, after cutting off any
+    torn rows left by a crash. Read the files back with Trajectories.
+    """
+
+    def __init__(self, directory, chunk=4096):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        steps = complete_rows(directory, STEP_COLUMNS)
+        episodes = recorded_episodes(directory, steps)
+        self.files = {}
+        for columns, rows in ((STEP_COLUMNS, steps), (EPISODE_COLUMNS, episodes)):
+            for name, dtype, shape in columns:
+                outfile = open(os.path.join(directory, name), 'ab')
+                outfile.truncate(rows * row_size(dtype, shape))
+                self.files[name] = outfile
+        self.steps = steps
+        self.episodes = episodes
+        self.chunk = chunk
+        self.buffers = dict((name, np.zeros((chunk, ) + shape, dtype=dtype))
+                            for name, dtype, shape in STEP_COLUMNS)
+        self.buffered = 0
+
+    def begin_episode(self, layout):
+        """Start an episode on the decoded maze layout (see grid_decoder)."""
+        self.files['starts'].write(np.array([self.steps + self.buffered], dtype=np.int64).tobytes())
+        self.files['layouts'].write(np.asarray(layout, dtype=np.int8).tobytes())
+        self.episodes += 1
+
+    def record(self, position, action, reward, done):
+        i = self.buffered
+        buffers = self.buffers
+        buffers['positions'][i] = position
+        buffers['actions'][i] = action
+        buffers['rewards'][i] = reward
+        buffers['dones'][i] = done
+        self.buffered = i + 1
+        if self.buffered == self.chunk:
+            self.flush()
+
+    def flush(self):
+        for name, dtype, shape in STEP_COLUMNS:
+            self.files[name].write(self.buffers[name][:self.buffered].tobytes())
+        self.steps += self.buffered
+        self.buffered = 0
+        for outfile in self.files.values():
+            outfile.flush()
+
+    def close(self):
+        self.flush()
+        for outfile in self.files.values():
+            outfile.close()
+
+
+class Trajectories(object):
+    """Memory-mapped view of a TrajectoryWriter directory.
+
+    positions, actions, rewards and dones hold one row per step; starts and
+    layouts one row per episode. transitions(rows) rebuilds the canvases
+    the DQN agents learn from (layout with SELF at the position, as in
+    maze2.Maze.get_canvas), in the format of ReplayMemory.get.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        steps = complete_rows(directory, STEP_COLUMNS)
+        episodes = recorded_episodes(directory, steps)
+        for columns, rows in ((STEP_COLUMNS, steps), (EPISODE_COLUMNS, episodes)):
+            for name, dtype, shape in columns:
+                if rows:
+                    column = np.memmap(os.path.join(directory, name), dtype=dtype, mode='r',
+                                       shape=(rows, ) + shape)
+                else:
+                    column = np.zeros((0, ) + shape, dtype=dtype)
+                setattr(self, name, column)
+        self.episode_of = None
+
+    def __len__(self):
+        return len(self.actions)
+
+    def episode(self, i):
+        """Step rows of episode i."""
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else len(self)
+        return np.arange(self.starts[i], end)
+
+    def episodes(self, rows):
+        """Episode index of each step row."""
+        if self.episode_of is None:
+            self.episode_of = np.searchsorted(self.starts, np.arange(len(self)), side='right') - 1
+        return self.episode_of[rows]
+
+    def canvases(self, rows, positions):
+        canvas = self.layouts[self.episodes(rows)].astype(np.float32)
+        x = np.clip(positions[:, 0], 0, MAP_LENGTH - 1)
+        z = np.clip(positions[:, 1], 0, MAP_WIDTH - 1)
+        canvas[np.arange(len(rows)), x, z] = SELF
+        return canvas.reshape((len(rows), -1))
+
+    def transitions(self, rows):
+        """(canvases, actions, rewards, canvases_next, dones) for step rows."""
+        rows = np.asarray(rows)
+        positions = self.positions[rows].astype(np.int64)
+        actions = self.actions[rows].astype(np.int64)
+        return (self.canvases(rows, positions), actions, np.array(self.rewards[rows]),
+                self.canvases(rows, positions + DELTAS[actions]), self.dones[rows].astype(bool))
+
+
+def shuffled_batches(trajectories, batch_size=4096, seed=None, prefetch=2):
+    """Yield one epoch of trajectories.transitions() in random batches of batch_size steps.
+
+    A thread builds up to prefetch batches ahead, so reading the memory-mapped
+    columns overlaps with training on the previous batch. Rows are sorted
+    within each batch to keep the reads close together on disk.
+    """
+    order = np.random.RandomState(seed).permutation(len(trajectories))
+    batches = queue.Queue(prefetch)
+
+    def load():
+        try:
+            for start in range(0, len(order), batch_size):
+                batches.put(trajectories.transitions(np.sort(order[start:start + batch_size])))
+        except Exception as e:
+            batches.put(e)
+        batches.put(None)
+
+    loader = threading.Thread(target=load)
+    loader.daemon = True
+    loader.start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch